@@ -0,0 +1,59 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+from services.data_service import provider_names
+
+# Code timed in a fresh interpreter for every run
+BASELINE = "import services.data_service"
+PROVIDER = "from services.data_service import load_provider; load_provider({!r})"
+
+TIMER = """
+import time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+"""
+
+
+def cold_start(code):
+    """
+    Return the seconds it takes a new interpreter to run the given code,
+    or None if it fails
+    """
+    result = subprocess.run([sys.executable, "-c", TIMER.format(code)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.description = "Measure the cold-start import cost of every service provider"
+    parser.add_argument(
+        "-n", "--runs", type=int, default=5, metavar="",
+        help="number of fresh interpreters timed per provider"
+    )
+    parser.add_argument(
+        "providers", nargs="*",
+        help="providers to measure; all of them if none are given"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    rows = [("(registry only)", BASELINE)]
+    rows += [(name, PROVIDER.format(name)) for name in args.providers or provider_names()]
+
+    print("{:<16} {:>10} {:>10}".format("provider", "median ms", "min ms"))
+    for name, code in rows:
+        timings = [cold_start(code) for run in range(args.runs)]
+        if None in timings:
+            print("{:<16} {:>21}".format(name, "import failed"))
+            continue
+        print("{:<16} {:>10.1f} {:>10.1f}".format(
+            name, statistics.median(timings) * 1000, min(timings) * 1000))
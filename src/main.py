@@ -1,5 +1,6 @@
 import argparse
 import logging
+import os
 import sys
 import utils
 import services.data_service as ds
@@ -10,6 +11,12 @@ def parse_arguments():
     parser.description = "A library that provides access to cloud storage services" \
                          "through a common interface for various cloud services"
 
+    parser.add_argument(
+        "-d", "--daemon", nargs="?", const="", metavar="SOCKET",
+        help="run the command through a running transfer daemon, listening on SOCKET "
+             "if given, otherwise on the daemon's default socket"
+    )
+
     subparsers = parser.add_subparsers(
         title="available providers",
         required=True, dest="service"
@@ -33,6 +40,14 @@ def parse_arguments():
         "-rp", "--remote_path", required=True, metavar="",
         help="path to Dropbox file or directory that will be downloaded"
     )
+    dbx_dlparser.add_argument(
+        "-m", "--folder_mode", choices=["zip", "files", "unzip"], default="zip",
+        help="download folders as a zip archive, file by file into a local directory tree, "
+             "or as a zip archive that is extracted while it is received"
+    )
+    dbx_dlparser.add_argument(
+        "-w", "--max_workers", type=int, metavar="", help="number of files downloaded concurrently"
+    )
 
     # Create subcommand for uploading to Dropbox
     dbx_uplparser = dbx_subparser.add_parser(
@@ -44,16 +59,37 @@ def parse_arguments():
     dbx_uplparser.add_argument(
         "-rp", "--remote_path", required=True, metavar="", help="path to Dropbox directory where content will be uploaded"
     )
+    dbx_uplparser.add_argument(
+        "-cs", "--chunk_size", type=lambda mb: int(mb) * 1024 * 1024, metavar="",
+        help="size in MB of the chunks large files are uploaded in; must be a multiple of 4, at most 150"
+    )
+    dbx_uplparser.add_argument(
+        "-w", "--max_workers", type=int, metavar="", help="number of files or chunks uploaded concurrently"
+    )
 
     # Create subcommand for deleting Dropbox content
     dbx_delparser = dbx_subparser.add_parser(
         "delete", help="delete Dropbox content"
     )
     dbx_delparser.add_argument(
-        "-rp", "--remote_path", required=True, metavar="",
-        help="path to Dropbox content that will be deleted"
+        "-rp", "--remote_path", required=True, nargs="+", metavar="",
+        help="paths to Dropbox content that will be deleted"
     )
 
+    # Create subcommands for copying and moving Dropbox content
+    for action, verb in (("copy", "copied"), ("move", "moved")):
+        dbx_relparser = dbx_subparser.add_parser(
+            action, help="{} Dropbox content to another folder".format(action)
+        )
+        dbx_relparser.add_argument(
+            "-rp", "--remote_path", required=True, nargs="+", metavar="",
+            help="paths to Dropbox content that will be {}".format(verb)
+        )
+        dbx_relparser.add_argument(
+            "-dp", "--dest_path", required=True, metavar="",
+            help="path to Dropbox folder the content will be {} into".format(verb)
+        )
+
     # Create subcommand for Box
     box_parser = subparsers.add_parser("box", help="use Box services")
     box_subparser = box_parser.add_subparsers(
@@ -71,6 +107,14 @@ def parse_arguments():
         "-rp", "--remote_path", required=True, metavar="",
         help="path to Box content that will be downloaded"
     )
+    box_dlparser.add_argument(
+        "-m", "--folder_mode", choices=["zip", "unzip", "files"], default="zip",
+        help="download folders as a zip archive, extract the archive while it is received, "
+             "or download them file by file into a local directory tree"
+    )
+    box_dlparser.add_argument(
+        "-w", "--max_workers", type=int, metavar="", help="number of files downloaded concurrently"
+    )
 
     # Create subcommand for uploading to Box
     box_uplparser = box_subparser.add_parser(
@@ -83,6 +127,9 @@ def parse_arguments():
         "-rp", "--remote_path", required=False, default="", metavar="",
         help="path to Box directory where content will be uploaded; leave empty to upload to root directory "
     )
+    box_uplparser.add_argument(
+        "-w", "--max_workers", type=int, metavar="", help="number of parts of large files uploaded concurrently"
+    )
 
     # Create subcommand for deleting Box content
     box_delparser = box_subparser.add_parser(
@@ -104,6 +151,8 @@ def parse_arguments():
                                  help="path to local directory where content will be downloaded")
     gdrive_dlparser.add_argument("-rp", "--remote_path", required=True, metavar="",
                                  help="path to Drive content that will be downloaded")
+    gdrive_dlparser.add_argument("-w", "--max_workers", type=int, metavar="",
+                                 help="number of files downloaded concurrently")
 
     # Create subcommand for uploading to Drive
     gdrive_uplparser = gdrive_subparser.add_parser(
@@ -112,12 +161,17 @@ def parse_arguments():
                                   help="path to local file or directory that will be uploaded")
     gdrive_uplparser.add_argument("-rp", "--remote_path", required=False, default="", metavar="",
                                   help="path to Drive directory where content will be uploaded; leave empty to upload to root directory")
+    gdrive_uplparser.add_argument("-w", "--max_workers", type=int, metavar="",
+                                  help="number of files uploaded concurrently")
+    gdrive_uplparser.add_argument("--preallocate_ids", action="store_true",
+                                  help="reserve Drive ids for the whole directory tree up front and upload its files concurrently")
 
     # Create subcommand for deleting Drive content
     gdrive_delparser = gdrive_subparser.add_parser(
         "delete", help="delete Drive content")
     gdrive_delparser.add_argument(
-        "-rp", "--remote_path", help="path to Drive content that will be deleted")
+        "-rp", "--remote_path", required=True, nargs="+", metavar="",
+        help="paths to Drive content that will be deleted")
 
     # Create subcommand for Amazon S3
     s3_parser = subparsers.add_parser("s3", help="use Amazon S3 services")
@@ -157,6 +211,39 @@ def parse_arguments():
         help="path to S3 content that will be deleted"
     )
 
+    # Create subcommand for running the transfer daemon
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="keep authenticated services warm and run jobs submitted with -d"
+    )
+    daemon_parser.add_argument(
+        "-s", "--socket", metavar="",
+        help="path of the Unix socket to listen on; defaults to ../data/daemon.sock"
+    )
+
+    # Create subcommand for running a manifest of operations
+    batch_parser = subparsers.add_parser(
+        "batch", help="run the operations of a JSON-lines manifest in a single process"
+    )
+    batch_parser.add_argument(
+        "-m", "--manifest", required=True, metavar="",
+        help="path to a manifest with one operation per line, e.g. "
+             "{\"service\": \"s3\", \"action\": \"upload\", \"local_path\": \"..\", \"remote_path\": \"..\"}"
+    )
+    batch_parser.add_argument(
+        "-o", "--results", metavar="",
+        help="path to the JSON-lines file the result of every operation is written to; "
+             "defaults to the manifest path with a .results.jsonl suffix"
+    )
+    batch_parser.add_argument(
+        "-w", "--max_workers", type=int, metavar="",
+        help="number of operations run concurrently; defaults to 4"
+    )
+    batch_parser.add_argument(
+        "-p", "--provider_limit", action="append", metavar="NAME=N",
+        type=lambda value: (value.split("=", 1)[0], int(value.split("=", 1)[1])),
+        help="run at most N operations of provider NAME concurrently; can be repeated"
+    )
+
     return parser.parse_args()
 
 
@@ -166,6 +253,28 @@ if __name__ == "__main__":
     args = parse_arguments()
     logging.debug(args)
 
+    # The daemon and batch modules are only imported when used, to keep
+    # them out of the start-up time of single commands
+    socket_path = vars(args).pop('daemon')
+    if args.service == 'daemon':
+        import services.daemon as daemon
+        daemon.serve(args.socket or daemon.SOCKET_PATH)
+        sys.exit(0)
+    if args.service == 'batch':
+        import services.jobs as jobs
+        results = args.results or os.path.splitext(args.manifest)[0] + '.results.jsonl'
+        limits = dict(args.provider_limit or [])
+        sys.exit(0 if jobs.run_batch(args.manifest, results,
+                                     args.max_workers or jobs.BATCH_WORKERS, limits) else 1)
+
+    # Hand the job over to the daemon, which may run in another directory
+    if socket_path is not None:
+        import services.daemon as daemon
+        job = vars(args)
+        if job.get('local_path'):
+            job['local_path'] = os.path.abspath(os.path.expanduser(job['local_path'].strip()))
+        sys.exit(0 if daemon.submit(job, socket_path or daemon.SOCKET_PATH) else 1)
+
     try:
         service = ds.DataService.build(args.service)
     except ds.DataServiceError as dse:
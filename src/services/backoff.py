@@ -0,0 +1,142 @@
+import logging
+import random
+import threading
+import time
+from services.transfer import MAX_WORKERS
+
+# Number of times a call is retried before its error is raised
+MAX_RETRIES = 6
+
+# Seconds of the first backoff, doubled for every retry up to MAX_DELAY
+BASE_DELAY = 0.5
+MAX_DELAY = 60
+
+
+class RateController:
+    """
+    Retries and paces the API calls of one provider, shared by all threads
+    that call it
+
+    classify(exception) decides what happens when a call fails. It returns
+    None for errors that shouldn't be retried, or a (throttled, retry_after)
+    pair: throttled is true when the provider signals it is overloaded or
+    rate limited, and retry_after is the delay in seconds it asked for, if
+    any.
+
+    Retries wait a jittered exponential backoff, or the Retry-After delay
+    when one is given. The number of calls in flight is adapted with AIMD:
+    it grows by one every time a full window of calls succeeds, and is
+    halved whenever the provider throttles, so that calls run close to the
+    provider's real rate limit
+    """
+
+    def __init__(self, name, classify, max_in_flight=MAX_WORKERS,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.name = name
+        self.classify = classify
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.condition = threading.Condition()
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.last_decrease = 0
+
+    def grow(self, max_in_flight):
+        """
+        Raise the maximum number of calls in flight, e.g. for an operation
+        that asks for more workers than the controller was created with
+        """
+        with self.condition:
+            if max_in_flight > self.max_in_flight:
+                self.limit += max_in_flight - self.max_in_flight
+                self.max_in_flight = max_in_flight
+                self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            if self.limit < self.max_in_flight:
+                self.limit = min(self.limit + 1 / self.limit, self.max_in_flight)
+                self.condition.notify_all()
+
+    def on_throttle(self):
+        """
+        Halve the number of calls in flight
+
+        Calls that were already in flight when the provider started
+        throttling fail together, so the limit is only halved once per
+        backoff period
+        """
+        with self.condition:
+            now = time.monotonic()
+            if now - self.last_decrease < self.base_delay:
+                return
+            self.last_decrease = now
+            self.limit = max(self.limit / 2, 1)
+            logging.warning("{} is throttling requests, limiting to {} calls in flight".format(
+                self.name, int(self.limit)))
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the given retry of a call
+        """
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), retrying it on errors classified as
+        retryable, and return its result
+
+        Calls must not be nested: a call that waits for a slot while its
+        caller holds one can deadlock once the limit drops to one
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                decision = self.classify(e)
+                if decision is None or attempt >= self.max_retries:
+                    raise
+                throttled, retry_after = decision
+                if throttled:
+                    self.on_throttle()
+                error = e
+            else:
+                self.on_success()
+                return result
+            finally:
+                self.release()
+
+            delay = self.delay(attempt, retry_after)
+            logging.warning("Retrying {} call in {:.2f} seconds ({}/{}): {}".format(
+                self.name, delay, attempt + 1, self.max_retries, error))
+            time.sleep(delay)
+            attempt += 1
+
+
+def parse_retry_after(value):
+    """
+    Return the delay in seconds of a Retry-After header value, or None if it
+    is missing or not a number of seconds
+    """
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None
@@ -5,11 +5,17 @@ import os
 import sys
 import json
 import webbrowser
-from threading import Thread, Event
+from collections import deque
+from threading import Thread, Event, Lock
 from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
 import bottle
 import boxsdk
+import requests
+from boxsdk.session.session import AuthorizedSession
+from services.backoff import RateController, parse_retry_after
 from services.data_service import DataService
+from services.transfer import MAX_WORKERS, RANGED_THRESHOLD, TransferSummary, prefetch, ranged_download, record_transfer, run_concurrently
+from services.zipstream import ZipStreamError, extract_written
 
 # hack to allow importing modules from parent directory
 sys.path.insert(0, os.path.abspath('..'))
@@ -18,19 +24,35 @@ MB = 1024 * 1024
 THRESHOLD = 32 * MB
 SEPARATOR = os.path.sep
 
+# Maximum number of items returned by a single folder listing request
+LIST_LIMIT = 1000
+
+# Fields requested for the items of folders that are downloaded file by file
+DOWNLOAD_FIELDS = ['type', 'id', 'name', 'size', 'sha1']
+
 
 class Box(DataService):
-    def __init__(self):
+    def __init__(self, max_workers=MAX_WORKERS):
         self.client = authenticate()
+        self.max_workers = max_workers
+        self.rate = RateController('Box', classify_error, max_workers)
+
+        # Dict mapping Box folder ids to the items they contain
+        self.folder_items = {}
+        self.cache_lock = Lock()
+
+    def reset_caches(self):
+        with self.cache_lock:
+            self.folder_items.clear()
 
     def get_path(self, id, is_folder=False):
         """
         Returns absolute path of Box file or folder with the given id
         """
         if is_folder:
-            info = self.client.folder(id).get()
+            info = self.rate.call(self.client.folder(id).get)
         else:
-            info = self.client.file(id).get()
+            info = self.rate.call(self.client.file(id).get)
 
         path = ''
         for item in info.path_collection['entries']:
@@ -39,19 +61,66 @@ class Box(DataService):
 
         return path
 
+    def get_items(self, folder_id, fields):
+        """
+        Return the items inside the Box folder with the given id, with the
+        given fields
+
+        The listing is paged, and restarted if a page is rate limited
+        """
+        return self.rate.call(lambda: list(self.client.folder(folder_id).get_items(
+            limit=LIST_LIMIT, use_marker=True, fields=fields)))
+
+    def list_folder(self, folder_id):
+        """
+        Return a dict mapping the names of the items inside the Box folder
+        with the given id to their (type, id)
+
+        Every folder is listed once, requesting only the fields needed
+        """
+        with self.cache_lock:
+            items = self.folder_items.get(folder_id)
+        if items is None:
+            logging.info("Listing Box folder '{}'".format(folder_id))
+            items = {}
+            for item in self.get_items(folder_id, ['type', 'id', 'name']):
+                items.setdefault(item.name, (item.type, item.id))
+            with self.cache_lock:
+                items = self.folder_items.setdefault(folder_id, items)
+        return items
+
+    def add_item(self, folder_id, item):
+        """
+        Record an item created inside the Box folder with the given id
+        """
+        with self.cache_lock:
+            items = self.folder_items.get(folder_id)
+            if items is not None:
+                items[item.name] = (item.type, item.id)
+
+    def forget_item(self, id):
+        """
+        Drop a deleted item, and the contents of a deleted folder, from the cache
+        """
+        with self.cache_lock:
+            self.folder_items.pop(id, None)
+            for items in self.folder_items.values():
+                for name, (key_type, item_id) in list(items.items()):
+                    if item_id == id:
+                        del items[name]
+
     def exists(self, parent_folder, key, key_type):
         """
         If key exists inside parent_folder on Box, return its id, otherwise return None
         """
-        for item in parent_folder.get_items():
-            if item.name == key:
-                if item.type == key_type:
-                    return item.id
+        item = self.list_folder(parent_folder.object_id).get(key)
+        if item is None:
+            return None
+        if item[0] == key_type:
+            return item[1]
 
-                # Item with same name but different type exists
-                else:
-                    return -1
-        return None
+        # Item with same name but different type exists
+        return -1
 
     def traverse(self, bx_path):
         """
@@ -75,7 +144,7 @@ class Box(DataService):
 
         logging.info("Traversing '{}'".format(bx_path))
 
-        current_folder = self.client.root_folder().get()
+        current_folder = self.client.folder('0')
         names = bx_path.split(SEPARATOR)
         for item in names:
             # Reached final item, return its id if it exists on Box
@@ -97,9 +166,64 @@ class Box(DataService):
                         item), utils.PrintStyle.ERROR)
                     sys.exit()
 
-    def download(self, localdir, bx_path):
+    def walk(self, folder_id, localdir):
+        """
+        Walk the Box folder with the given id breadth-first, creating the
+        matching local directories below localdir
+
+        Yield a (file info, local path) pair for every file found
+        """
+        folders = deque([(folder_id, localdir)])
+        while folders:
+            folder_id, path = folders.popleft()
+            logging.info("Creating local directory '{}'".format(path))
+            os.makedirs(path, exist_ok=True)
+            for item in self.get_items(folder_id, DOWNLOAD_FIELDS):
+                item_path = os.path.join(path, item.name)
+                if item.type == 'folder':
+                    folders.append((item.id, item_path))
+                elif item.type == 'file':
+                    yield item, item_path
+
+    def download_folder(self, folder_info, localdir, max_workers=None):
+        """
+        Download a Box folder file by file into a matching local tree
+
+        Files are downloaded concurrently while the rest of the tree is still
+        being walked. Local files whose SHA-1 matches the one reported by Box
+        are skipped
+
+        Returns true if all files were downloaded, otherwise returns false
+        """
+        def download_job(job):
+            file_info, path = job
+            if os.path.isfile(path) and os.path.getsize(path) == file_info.size \
+                    and file_sha1(path).hex() == file_info.sha1:
+                logging.info("Skipping unchanged file '{}'".format(path))
+                return 0
+            logging.info("Downloading file '{}'".format(path))
+            self.download_file(file_info, path)
+            return file_info.size
+
+        root = os.path.join(localdir, folder_info.name)
+        jobs = prefetch(self.walk(folder_info.id, root))
+        summary = TransferSummary()
+        for (file_info, path), size, e in run_concurrently(
+                download_job, jobs, max_workers or self.max_workers):
+            if e is None:
+                summary.add_success(path, size)
+            else:
+                summary.add_failure(path, e)
+        return summary.report("Downloaded")
+
+    def download(self, localdir, bx_path, folder_mode='zip', max_workers=None):
         """
         Download a file or folder from Box
+
+        With folder_mode 'zip', folders are downloaded as a zip archive. With
+        'unzip', the archive is extracted while it is being received, without
+        storing the archive itself. With 'files', they are downloaded file by
+        file into a local directory tree, skipping files that are unchanged
         """
         localdir = os.path.expanduser(localdir)
         localdir = localdir.replace('/', SEPARATOR)
@@ -114,9 +238,9 @@ class Box(DataService):
         # Get item that will be downloaded
         id, key_type = self.traverse(bx_path)
         if key_type == 'folder':
-            item_info = self.client.folder(id).get()
+            item_info = self.rate.call(self.client.folder(id).get)
         elif key_type == 'file':
-            item_info = self.client.file(id).get()
+            item_info = self.rate.call(self.client.file(id).get)
 
         logging.info('Box directory:' + bx_path)
         logging.info('Local directory:' + localdir)
@@ -126,18 +250,40 @@ class Box(DataService):
             if not item_info.type == 'folder':
                 logging.info('Downloading file ' + bx_path)
                 dl_path = os.path.join(localdir, item_info.name)
-                with open(dl_path, 'wb') as f:
-                    self.client.file(item_info.id).download_to(f)
+                self.download_file(item_info, dl_path)
+                record_transfer(item_info.size)
+
+            # Download folder file by file
+            elif folder_mode == 'files':
+                logging.info('Downloading files of folder ' + bx_path)
+                if not self.download_folder(item_info, localdir, max_workers):
+                    return None
+
+            # Download folder and extract it on the fly. Data already
+            # extracted can't be taken back, so the stream isn't retried
+            elif folder_mode == 'unzip':
+                logging.info('Downloading and extracting folder ' + bx_path)
+                folder = [self.client.folder(item_info.id)]
+                count = extract_written(
+                    lambda stream: self.client.download_zip(
+                        item_info.name, folder, stream),
+                    localdir)
+                logging.info('Extracted {} files'.format(count))
 
             # Download zipped folder
             else:
                 logging.info('Downloading folder ' + bx_path)
                 dl_path = os.path.join(localdir, item_info.name) + '.zip'
-                with open(dl_path, 'wb') as f:
-                    folder = [self.client.folder(item_info.id)]
-                    self.client.download_zip(item_info.name, folder, f)
+                folder = [self.client.folder(item_info.id)]
 
-        except boxsdk.BoxAPIException as e:
+                def download_zip():
+                    with open(dl_path, 'wb') as f:
+                        self.client.download_zip(item_info.name, folder, f)
+                self.rate.call(download_zip)
+                record_transfer(os.path.getsize(dl_path))
+
+        except (boxsdk.BoxException, requests.exceptions.RequestException,
+                ZipStreamError, OSError) as e:
             utils.print_string("Could not download '{}': {}".format(
                 bx_path, e), utils.PrintStyle.ERROR)
             return None
@@ -145,87 +291,152 @@ class Box(DataService):
         utils.print_string("Successfully downloaded '{}'".format(
             item_info.name), utils.PrintStyle.SUCCESS)
 
-    def upload_file(self, localdir, folder_id, file_id):
+    def download_file(self, file_info, dl_path):
+        """
+        Download Box file to the given local path
+
+        Large files are downloaded as concurrent byte ranges
+        """
+        file = self.client.file(file_info.id)
+        if file_info.size > RANGED_THRESHOLD:
+            logging.info("Downloading '{}' in concurrent ranges".format(
+                file_info.name))
+            ranged_download(
+                lambda start, end: self.rate.call(file.content, byte_range=(start, end)),
+                file_info.size, dl_path, max_workers=self.max_workers)
+        else:
+            def download_to():
+                with open(dl_path, 'wb') as f:
+                    file.download_to(f)
+            self.rate.call(download_to)
+
+    def upload_part(self, uploader, localdir, offset, file_size, sha1):
+        """
+        Upload the part of a local file that starts at offset to an upload
+        session, retrying transient and rate-limited failures
+
+        The part is added to sha1 once it has been read
+
+        Return the uploaded part
+        """
+        with open(localdir, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(uploader.part_size)
+        sha1.add(offset, chunk)
+
+        return self.rate.call(uploader.upload_part_bytes, chunk, offset, file_size)
+
+    def upload_parts(self, uploader, localdir, file_size, max_workers=None):
+        """
+        Upload every part of a local file to an upload session concurrently
+        and commit the session
+
+        The SHA-1 of the whole file is built from the parts as they are
+        read for upload, so the file is only read once. The session is
+        aborted if a part can't be uploaded
+
+        Return the uploaded file
+        """
+        max_workers = max_workers or self.max_workers
+        offsets = range(0, file_size, uploader.part_size)
+        sha1 = OrderedSha1()
+
+        parts = []
+        bytes_uploaded = 0
+        try:
+            for offset, part, e in run_concurrently(
+                    lambda offset: self.upload_part(uploader, localdir, offset, file_size, sha1),
+                    offsets, max_workers):
+                if e is not None:
+                    raise e
+                parts.append(part)
+                bytes_uploaded += part['size']
+                logging.info("Uploaded {:.2f} of {:.2f} MB".format(
+                    bytes_uploaded / MB, file_size / MB))
+        except Exception:
+            logging.info("Aborting upload session {}".format(uploader.id))
+            try:
+                uploader.abort()
+            except boxsdk.BoxAPIException as e:
+                logging.warning("Could not abort upload session {}: {}".format(
+                    uploader.id, e))
+            raise
+
+        parts.sort(key=lambda part: part['offset'])
+        return self.rate.call(uploader.commit, content_sha1=sha1.digest(file_size), parts=parts)
+
+    def upload_file(self, localdir, folder_id, file_id, max_workers=None):
         """
         Upload file if it doesn't exist
 
         If the file already exists, update it
 
-        Use chunked upload/update for large files
+        Use chunked upload/update for large files, uploading parts concurrently
+
+        Returns true if the upload succeeded, otherwise returns false
         """
         file_size = os.path.getsize(localdir)
 
-        with open(localdir, 'rb') as f:
-
-            # Large file, upload in chunks
-            if file_size > THRESHOLD:
-                try:
-                    sha1 = hashlib.sha1()
-                    parts = []
-
-                    # Upload file if it doesn't exist, else update it
-                    if file_id is None:
-                        logging.info(
-                            "Uploading '{}' in chunks".format(localdir))
-                        uploader = self.client.folder(folder_id).create_upload_session(file_size=file_size,
-                                                                                       file_name=localdir.split(SEPARATOR)[
-                                                                                           -1])
-                    else:
-                        logging.info(
-                            "Updating '{}' in chunks".format(localdir))
-                        uploader = self.client.file(
-                            file_id).create_upload_session(file_size=file_size)
-
-                    logging.warning("Chunk size: {}".format(uploader.part_size / MB))
-                    session_id = uploader.id
-                    bytes_uploaded = 0
-                    for part_num in range(uploader.total_parts):
-                        chunk = f.read(uploader.part_size)
-                        uploaded_part = uploader.upload_part_bytes(
-                            chunk, part_num * uploader.part_size, file_size)
-                        bytes_uploaded += len(chunk)
-                        logging.info("Uploaded {} MB".format(
-                            bytes_uploaded / (1024 * 1024)))
-                        parts.append(uploaded_part)
-                        sha1.update(chunk)
-
-                    content_sha1 = sha1.digest()
-                    logging.info("Session id: {}".format(session_id))
-
-
-                    uploader.commit(content_sha1=content_sha1, parts=parts)
-                    utils.print_string("Chunked upload of '{}' completed".format(
-                        localdir), utils.PrintStyle.SUCCESS)
-
-                except boxsdk.BoxAPIException as e:
-                    utils.print_string("Could not upload '{}' in chunks: {}".format(localdir, e),
-                                       utils.PrintStyle.ERROR)
-                    sys.exit()
+        # Large file, upload in chunks
+        if file_size > THRESHOLD:
+            try:
+                # Upload file if it doesn't exist, else update it
+                if file_id is None:
+                    logging.info(
+                        "Uploading '{}' in chunks".format(localdir))
+                    uploader = self.rate.call(self.client.folder(folder_id).create_upload_session,
+                                              file_size=file_size, file_name=localdir.split(SEPARATOR)[-1])
+                else:
+                    logging.info(
+                        "Updating '{}' in chunks".format(localdir))
+                    uploader = self.rate.call(
+                        self.client.file(file_id).create_upload_session, file_size=file_size)
+
+                logging.info("Session id: {}, chunk size: {} MB".format(
+                    uploader.id, uploader.part_size / MB))
+                uploaded_file = self.upload_parts(
+                    uploader, localdir, file_size, max_workers)
+                if file_id is None:
+                    self.add_item(folder_id, uploaded_file)
+                utils.print_string("Chunked upload of '{}' completed".format(
+                    localdir), utils.PrintStyle.SUCCESS)
+
+            except (boxsdk.BoxAPIException, boxsdk.BoxNetworkException, OSError) as e:
+                utils.print_string("Could not upload '{}' in chunks: {}".format(localdir, e),
+                                   utils.PrintStyle.ERROR)
+                return False
+
+        # Small file, upload in one request
+        else:
+            try:
+                # Upload file it doesn't exist, else update it
+                if file_id is None:
+                    logging.info(
+                        "Uploading '{}' in a single request".format(localdir))
+                    uploaded_file = self.rate.call(
+                        self.client.folder(folder_id).upload, localdir)
+                    self.add_item(folder_id, uploaded_file)
+                else:
+                    logging.info(
+                        "Updating '{}' in a single request".format(localdir))
+                    self.rate.call(self.client.file(file_id).update_contents, localdir)
 
-            # Small file, upload in one request
-            else:
-                try:
-                    # Upload file it doesn't exist, else update it
-                    if file_id is None:
-                        logging.info(
-                            "Uploading '{}' in a single request".format(localdir))
-                        self.client.folder(folder_id).upload(localdir)
-                    else:
-                        logging.info(
-                            "Updating '{}' in a single request".format(localdir))
-                        self.client.file(file_id).update_contents(localdir)
+                utils.print_string("Upload of '{}' completed".format(
+                    localdir), utils.PrintStyle.SUCCESS)
 
-                    utils.print_string("Upload of '{}' completed".format(
-                        localdir), utils.PrintStyle.SUCCESS)
+            except boxsdk.BoxAPIException as e:
+                utils.print_string("Could not upload '{}': {}".format(
+                    localdir, e), utils.PrintStyle.ERROR)
+                return False
 
-                except boxsdk.BoxAPIException as e:
-                    utils.print_string("Could not upload '{}': {}".format(
-                        localdir, e), utils.PrintStyle.ERROR)
-                    sys.exit()
+        record_transfer(file_size)
+        return True
 
-    def upload(self, localdir, bx_path):
+    def upload(self, localdir, bx_path, max_workers=None):
         """
         Upload a file or folder to Box
+
+        Parts of large files are uploaded with up to max_workers in flight
         """
         localdir = os.path.expanduser(localdir)
         localdir = localdir.replace('/', SEPARATOR)
@@ -244,7 +455,7 @@ class Box(DataService):
 
         # Get Box directory to upload to
         id, key_type = self.traverse(bx_path)
-        folder_info = self.client.folder(id).get()
+        folder = self.client.folder(id)
 
         logging.info("Box directory: " + bx_path)
         logging.info("Local directory: " + localdir)
@@ -253,11 +464,12 @@ class Box(DataService):
         if os.path.isfile(localdir):
             logging.info(localdir + ' is a local file')
 
-            folder_id = folder_info.id
+            folder_id = folder.object_id
             key = localdir.split(SEPARATOR)[-1]
-            id = self.exists(self.client.folder(folder_id), key, 'file')
+            id = self.exists(folder, key, 'file')
             if id != -1:
-                self.upload_file(localdir, folder_id, id)
+                if not self.upload_file(localdir, folder_id, id, max_workers):
+                    return None
             else:
                 utils.print_string("Cannot upload '{}', name already in use by another item of different type".format(
                     key), utils.PrintStyle.ERROR)
@@ -269,14 +481,17 @@ class Box(DataService):
             name = localdir.split(SEPARATOR)[-1]
 
             # Create subfolder where contents wil be uploaded, if it doesn't already exist
-            id = self.exists(self.client.folder(folder_info.id), name, 'folder')
+            id = self.exists(folder, name, 'folder')
             if id is None:
                 logging.info('Creating Box subfolder ' + name)
-                id = self.client.folder(folder_info.id).create_subfolder(name).get().id
+                subfolder = self.rate.call(folder.create_subfolder, name)
+                self.add_item(folder.object_id, subfolder)
+                id = subfolder.id
             current_folder = self.client.folder(id)
 
             # Dict mapping Box folder ids with their local absolute paths
             folders = {}
+            failures = 0
 
             for dn, dirs, files in os.walk(localdir):
                 subfolder = dn[len(localdir):].strip(os.path.sep)
@@ -297,7 +512,8 @@ class Box(DataService):
                         logging.info('Skipping generated file: ' + name)
                     else:
                         id = self.exists(current_folder, name, 'file')
-                        self.upload_file(fullname, current_folder.get().id, id)
+                        if not self.upload_file(fullname, current_folder.object_id, id, max_workers):
+                            failures += 1
 
                 # Then choose which subdirectories to traverse
                 keep = []
@@ -317,10 +533,17 @@ class Box(DataService):
                         # If folder doesn't exist on Box, create it
                         if id is None:
                             logging.info('Creating Box subfolder ' + name)
-                            id = current_folder.create_subfolder(name).get().id
+                            subfolder = self.rate.call(current_folder.create_subfolder, name)
+                            self.add_item(current_folder.object_id, subfolder)
+                            id = subfolder.id
                         folders[os.path.join(dn, name)] = id
                 dirs[:] = keep
 
+            if failures:
+                utils.print_string("{} uploads failed".format(
+                    failures), utils.PrintStyle.ERROR)
+                return None
+
         utils.print_string("All uploads successfull", utils.PrintStyle.SUCCESS)
 
     def delete(self, bx_path):
@@ -337,7 +560,8 @@ class Box(DataService):
             item = self.client.file(id)
 
         # Delete item
-        if item.delete():
+        if self.rate.call(item.delete):
+            self.forget_item(id)
             utils.print_string("Successfully deleted '{}'".format(
                 bx_path), utils.PrintStyle.SUCCESS)
         else:
@@ -348,6 +572,90 @@ class Box(DataService):
         None
 
 
+def classify_error(e):
+    """
+    Decide whether a failed Box API call should be retried
+
+    Returns None if it shouldn't, otherwise a (throttled, retry_after) pair
+    for RateController. Retry-After is only sent with 429 responses
+    """
+    if isinstance(e, boxsdk.BoxNetworkException):
+        return False, None
+    if isinstance(e, boxsdk.BoxAPIException):
+        if e.status == 429:
+            headers = e.headers or {}
+            return True, parse_retry_after(headers.get('Retry-After'))
+        if e.status == 503:
+            return True, None
+        if e.status >= 500:
+            return False, None
+    return None
+
+
+class RateControlledSession(AuthorizedSession):
+    """
+    Box session that leaves rate limits and server errors to the
+    RateController of the service, which must see them to adapt
+
+    Expired access tokens are still refreshed and the request resent
+    """
+
+    def _get_retry_request_callable(self, network_response, attempt_number, request,
+                                    skip_retry_codes, session_renewal_needed=False, **kwargs):
+        if not (session_renewal_needed and request.auto_session_renewal) \
+                and network_response is not None \
+                and (network_response.status_code == 429 or network_response.status_code >= 500):
+            return None
+        return super()._get_retry_request_callable(
+            network_response, attempt_number, request, skip_retry_codes,
+            session_renewal_needed, **kwargs)
+
+
+class OrderedSha1:
+    """
+    SHA-1 of a file whose parts are read concurrently, in any order
+
+    Parts are hashed in offset order, each one as soon as every part before
+    it has been added. Parts that arrive early are held until then, which is
+    only a few, since parts are read in order as workers pick them up
+    """
+
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.offset = 0
+        self.parts = {}
+        self.lock = Lock()
+
+    def add(self, offset, data):
+        with self.lock:
+            self.parts[offset] = data
+            while self.offset in self.parts:
+                data = self.parts.pop(self.offset)
+                self.sha1.update(data)
+                self.offset += len(data)
+
+    def digest(self, size):
+        """
+        Return the digest, once parts covering size bytes have been added
+        """
+        with self.lock:
+            if self.offset != size:
+                raise ValueError("Only {} of {} bytes were hashed".format(
+                    self.offset, size))
+            return self.sha1.digest()
+
+
+def file_sha1(path):
+    """
+    Return the SHA-1 digest of a local file, reading it sequentially
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            sha1.update(chunk)
+    return sha1.digest()
+
+
 def store_tokens(access_token, refresh_token):
     """
     Store access and refresh token
@@ -422,7 +730,7 @@ def authenticate_OAuth2():
     logging.info('access_token: ' + access_token)
     logging.info('refresh_token: ' + refresh_token)
 
-    return boxsdk.Client(oauth)
+    return boxsdk.Client(oauth, session=RateControlledSession(oauth))
 
 
 def authenticate():
@@ -443,7 +751,7 @@ def authenticate():
                 access_token=data.get("access_token"),
                 refresh_token=data.get("refresh_token"),
             )
-            client = boxsdk.Client(oauth)
+            client = boxsdk.Client(oauth, session=RateControlledSession(oauth))
             client.user().get()
         except boxsdk.BoxOAuthException as e:
             utils.print_string(
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import utils
+from services.jobs import JobOutput, ServiceCache, SinkLogHandler, timed_job
+
+# Default path of the Unix socket the daemon listens on
+SOCKET_PATH = '../data/daemon.sock'
+
+
+class JobStream(JobOutput):
+    """
+    Streams the output of a job back to the client that submitted it, one
+    JSON message per line
+    """
+
+    def __init__(self, wfile):
+        super().__init__()
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(message) + '\n').encode())
+                self.wfile.flush()
+            except OSError:
+                # Client went away, let the job finish anyway
+                pass
+
+    def emit(self, message, style):
+        self.send({'type': 'output', 'style': style.name, 'message': str(message)})
+
+    def log(self, message):
+        self.send({'type': 'log', 'message': message})
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Reads a single job from a client connection and runs it
+    """
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+        except ValueError as e:
+            self.wfile.write((json.dumps({'type': 'result', 'ok': False, 'error': str(e)}) + '\n').encode())
+            return
+
+        logging.info("Running job: {}".format(job))
+        stream = JobStream(self.wfile)
+        ok, elapsed = timed_job(self.server.cache, job, stream)
+        logging.info("Job finished in {:.2f} seconds, ok: {}".format(elapsed, ok))
+        stream.send({'type': 'result', 'ok': ok, 'elapsed': elapsed})
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, JobHandler)
+        self.cache = ServiceCache()
+
+
+def serve(socket_path=SOCKET_PATH):
+    """
+    Run the daemon, accepting jobs on the given Unix socket until interrupted
+
+    Services are authenticated on their first job and kept warm for all
+    later ones
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    handler = SinkLogHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    logging.getLogger().addHandler(handler)
+
+    server = JobServer(socket_path)
+    utils.print_string("Listening for jobs on '{}'".format(socket_path),
+                       utils.PrintStyle.SUCCESS)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down daemon")
+    finally:
+        server.server_close()
+        server.cache.close()
+        os.remove(socket_path)
+
+
+def submit(job, socket_path=SOCKET_PATH):
+    """
+    Send a job to a running daemon and print its output as it arrives
+
+    Log messages of the job are written to stderr, like those of a local run
+
+    Returns true if the job succeeded, otherwise returns false
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError as e:
+            utils.print_string("Could not connect to daemon at '{}': {}".format(
+                socket_path, e), utils.PrintStyle.ERROR)
+            return False
+
+        client.sendall((json.dumps(job) + '\n').encode())
+        with client.makefile('rb') as f:
+            for line in f:
+                message = json.loads(line)
+                if message['type'] == 'output':
+                    utils.print_string(message['message'],
+                                       utils.PrintStyle[message['style']])
+                elif message['type'] == 'log':
+                    print(message['message'], file=sys.stderr)
+                elif message['type'] == 'result':
+                    logging.info("Job finished in {:.3f} seconds".format(
+                        message.get('elapsed', 0)))
+                    return message['ok']
+
+    utils.print_string("Daemon closed the connection before the job finished",
+                       utils.PrintStyle.ERROR)
+    return False
@@ -1,37 +1,125 @@
+import importlib
 from abc import ABCMeta, abstractmethod
 
+# Module and class implementing each built-in service. Modules are only
+# imported when their service is requested, so that running one service
+# doesn't pay for loading the SDKs of all the others
+PROVIDERS = {
+    'dropbox': ('.dropbox_implementation', 'Dropbox'),
+    'box': ('.box_implementation', 'Box'),
+    'gdrive': ('.gdrive_implementation', 'Gdrive'),
+    's3': ('.s3_implementation', 'S3'),
+}
+
+# Entry point group through which installed packages can register more services
+ENTRY_POINT_GROUP = 'cloud_storage_services.providers'
+
 
 class DataServiceError(Exception):
     pass
 
 
+def provider_entry_points():
+    """
+    Return the entry points registered for additional services
+    """
+    # Imported here, as it is only needed for services that aren't built-in
+    from importlib.metadata import entry_points
+    try:
+        return list(entry_points(group=ENTRY_POINT_GROUP))
+    except TypeError:
+        # Python versions before 3.10 return a dict of groups
+        return list(entry_points().get(ENTRY_POINT_GROUP, []))
+
+
+def provider_names():
+    """
+    Return the names of all built-in and registered services
+    """
+    return list(PROVIDERS) + [entry_point.name for entry_point in provider_entry_points()
+                              if entry_point.name not in PROVIDERS]
+
+
+def load_provider(service_name):
+    """
+    Import the module of the given service and return its DataService class
+
+    Built-in services take precedence over entry points with the same name
+    """
+    if service_name in PROVIDERS:
+        module_name, class_name = PROVIDERS[service_name]
+        module = importlib.import_module(module_name, __package__)
+        return getattr(module, class_name)
+
+    for entry_point in provider_entry_points():
+        if entry_point.name == service_name:
+            return entry_point.load()
+    raise DataServiceError("Unsupported service '%s'" % service_name)
+
+
 class DataService(metaclass=ABCMeta):
     @classmethod
     def build(cls, service_name):
-        from .dropbox_implementation import Dropbox
-        from .box_implementation import Box
-        from .s3_implementation import S3
-        from .gdrive_implementation import Gdrive
-
-        if service_name == 'dropbox':
-            service = Dropbox()
-        elif service_name == 'box':
-            service = Box()
-        elif service_name == 'gdrive':
-            service = Gdrive()
-        elif service_name == 's3':
-            service = S3()
-        else:
-            raise DataServiceError("Unsupported service '%s'" % service_name)
-        return service
+        return load_provider(service_name)()
 
     def execute_action(self, args):
+        # Any provider-specific options are passed on as keyword arguments
+        options = {key: value for key, value in vars(args).items()
+                   if key not in ('service', 'action', 'local_path', 'remote_path')}
+
+        # Some actions take several remote paths at once
+        if isinstance(args.remote_path, list):
+            remote_path = [path.strip() for path in args.remote_path]
+        else:
+            remote_path = args.remote_path.strip()
+
         if args.action == 'upload':
-            self.upload(args.local_path.strip(), args.remote_path.strip())
+            self.upload(args.local_path.strip(), remote_path, **options)
         elif args.action == 'download':
-            self.download(args.local_path.strip(), args.remote_path.strip())
+            self.download(args.local_path.strip(), remote_path, **options)
         elif args.action == 'delete':
-            self.delete(args.remote_path.strip())
+            self.delete(remote_path, **options)
+        elif args.action == 'copy':
+            self.copy(remote_path, **options)
+        elif args.action == 'move':
+            self.move(remote_path, **options)
+
+    @property
+    def provider_name(self):
+        """
+        Name of the service, as used for its scheduler cap
+        """
+        return type(self).__name__.lower()
+
+    async def execute_action_async(self, args, scheduler):
+        """
+        Run execute_action on the given Scheduler, under this provider's cap
+        """
+        return await scheduler.run(self.provider_name, self.execute_action, args)
+
+    async def download_async(self, scheduler, local_dir, path, **options):
+        """
+        Run download on the given Scheduler, under this provider's cap
+        """
+        return await scheduler.run(self.provider_name, self.download, local_dir, path, **options)
+
+    async def upload_async(self, scheduler, local_dir, path, **options):
+        """
+        Run upload on the given Scheduler, under this provider's cap
+        """
+        return await scheduler.run(self.provider_name, self.upload, local_dir, path, **options)
+
+    async def delete_async(self, scheduler, path, **options):
+        """
+        Run delete on the given Scheduler, under this provider's cap
+        """
+        return await scheduler.run(self.provider_name, self.delete, path, **options)
+
+    def reset_caches(self):
+        """
+        Drop state cached from earlier operations, which may be stale by
+        the time a long-lived service runs the next one
+        """
 
     @abstractmethod
     def download(self, local_dir, path):
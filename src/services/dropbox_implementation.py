@@ -8,7 +8,10 @@ import time
 import dropbox
 import requests
 import utils
+from .backoff import RateController
 from .data_service import DataService
+from .transfer import MAX_WORKERS, TransferSummary, chunked, prefetch, record_transfer, run_concurrently
+from .zipstream import ZipStreamError, extract_stream
 
 # hack to allow importing modules from parent directory
 sys.path.insert(0, os.path.abspath('..'))
@@ -18,14 +21,92 @@ CHUNK_SIZE = 32 * MB
 THRESHOLD = 32 * MB
 SEPARATOR = os.path.sep
 
+# Chunks of concurrent upload sessions, except the last, must be multiples of this
+CHUNK_ALIGNMENT = 4 * MB
+
+# Largest chunk Dropbox accepts in a single upload request
+MAX_CHUNK_SIZE = 150 * MB
+
+# Maximum number of upload sessions started or finished in a single batch
+UPLOAD_BATCH_SIZE = 1000
+
+# Seconds to wait between polls of an asynchronous batch job
+POLL_INTERVAL = 1
+
+# Maximum number of entries deleted, copied or moved in a single batch job
+OPERATION_BATCH_SIZE = 1000
+
+# Size of the pieces a streamed zip download is read in
+STREAM_CHUNK_SIZE = 1 * MB
+
+
+class BatchJobError(Exception):
+    pass
+
 
 class Dropbox(DataService):
-    def __init__(self):
+    def __init__(self, max_workers=MAX_WORKERS):
         self.client = authenticate()
+        self.max_workers = max_workers
+        self.rate = RateController('Dropbox', classify_error, max_workers)
+
+    def list_folder(self, dbx_path):
+        """
+        Yield the metadata of every entry below a Dropbox folder, following
+        the listing cursor until all pages have been read
+        """
+        result = self.rate.call(self.client.files_list_folder, dbx_path, recursive=True)
+        while True:
+            yield from result.entries
+            if not result.has_more:
+                break
+            result = self.rate.call(self.client.files_list_folder_continue, result.cursor)
+
+    def download_folder(self, local_path, md, max_workers=None):
+        """
+        Download a Dropbox folder file by file into a matching local tree
+
+        Files are downloaded concurrently while the rest of the folder is
+        still being listed
+
+        Returns true if all files were downloaded, otherwise returns false
+        """
+        root = os.path.join(local_path, md.name)
+
+        def jobs():
+            for entry in prefetch(self.list_folder(md.path_lower)):
+                relative = entry.path_display[len(md.path_display):].strip('/')
+                path = os.path.join(root, relative.replace('/', SEPARATOR))
+                if isinstance(entry, dropbox.files.FolderMetadata):
+                    logging.info("Creating local directory '{}'".format(path))
+                    os.makedirs(path, exist_ok=True)
+                elif isinstance(entry, dropbox.files.FileMetadata):
+                    yield entry, path
+
+        def download_job(job):
+            entry, path = job
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            logging.info("Downloading file '{}'".format(entry.path_display))
+            self.rate.call(self.client.files_download_to_file, path, entry.id)
+            return entry.size
+
+        os.makedirs(root, exist_ok=True)
+        summary = TransferSummary()
+        for (entry, path), size, e in run_concurrently(download_job, jobs(), max_workers or self.max_workers):
+            if e is None:
+                summary.add_success(entry.path_display, size)
+            else:
+                summary.add_failure(entry.path_display, e)
+        return summary.report("Downloaded")
 
-    def download(self, local_path, dbx_path):
+    def download(self, local_path, dbx_path, folder_mode='zip', max_workers=None):
         """
         Download a file or folder from Dropbox
+
+        With folder_mode 'zip', folders are downloaded as a zip archive. With
+        'files', they are downloaded file by file into a local directory tree.
+        With 'unzip', the zip archive is extracted while it is being received,
+        without storing the archive itself
         """
         local_path = os.path.expanduser(local_path)
         local_path = local_path.replace('/', SEPARATOR)
@@ -40,7 +121,7 @@ class Dropbox(DataService):
         dbx_path = dbx_path.rstrip('/')
 
         try:
-            md = self.client.files_get_metadata(dbx_path)
+            md = self.rate.call(self.client.files_get_metadata, dbx_path)
         except dropbox.exceptions.ApiError as err:
             utils.print_string("Could not get metadata for path '{}': {}".format(
                 dbx_path, err), utils.PrintStyle.ERROR)
@@ -55,14 +136,49 @@ class Dropbox(DataService):
             name = dbx_path.split('/')[-1]
             local_path += name
             try:
-                md = self.client.files_download_to_file(
-                    local_path, dbx_path)
+                md = self.rate.call(self.client.files_download_to_file,
+                                    local_path, dbx_path)
             except dropbox.exceptions.ApiError as err:
                 utils.print_string(
                     "Could not download file '{}': {}".format(dbx_path, err), utils.PrintStyle.ERROR)
                 return None
+            record_transfer(md.size)
             utils.print_string(
                 "File '{}' downloaded successfully!".format(dbx_path.split('/')[-1]), utils.PrintStyle.SUCCESS)
+        elif folder_mode == 'files':
+            logging.info("Dropbox path '{}' is a directory".format(dbx_path))
+            try:
+                if not self.download_folder(local_path, md, max_workers):
+                    return None
+            except dropbox.exceptions.ApiError as err:
+                utils.print_string(
+                    "Could not download directory '{}': {}".format(
+                        dbx_path, err),
+                    utils.PrintStyle.ERROR
+                )
+                return None
+            utils.print_string("Folder named {} downloaded successfully!".format(
+                dbx_path.split('/')[-1]), utils.PrintStyle.SUCCESS)
+        elif folder_mode == 'unzip':
+            logging.info("Dropbox path '{}' is a directory".format(dbx_path))
+            try:
+                md, res = self.rate.call(self.client.files_download_zip, dbx_path)
+                try:
+                    count = extract_stream(
+                        res.iter_content(STREAM_CHUNK_SIZE), local_path)
+                finally:
+                    res.close()
+            except (dropbox.exceptions.ApiError, requests.exceptions.RequestException,
+                    ZipStreamError, OSError) as err:
+                utils.print_string(
+                    "Could not download directory '{}': {}".format(
+                        dbx_path, err),
+                    utils.PrintStyle.ERROR
+                )
+                return None
+            logging.info("Extracted {} files".format(count))
+            utils.print_string("Folder named {} downloaded successfully!".format(
+                dbx_path.split('/')[-1]), utils.PrintStyle.SUCCESS)
         else:
             logging.info("Dropbox path '{}' is a directory".format(dbx_path))
             name = dbx_path.split('/')[-1]
@@ -70,8 +186,8 @@ class Dropbox(DataService):
                 name += ".zip"
             local_path += name
             try:
-                self.client.files_download_zip_to_file(
-                    local_path, dbx_path)
+                self.rate.call(self.client.files_download_zip_to_file,
+                               local_path, dbx_path)
             except dropbox.exceptions.ApiError as err:
                 utils.print_string(
                     "Could not download directory '{}': {}".format(
@@ -79,17 +195,18 @@ class Dropbox(DataService):
                     utils.PrintStyle.ERROR
                 )
                 return None
+            record_transfer(os.path.getsize(local_path))
             utils.print_string("Folder named {} downloaded successfully!".format(
                 dbx_path.split('/')[-1]), utils.PrintStyle.SUCCESS)
 
-    def upload_file(self, fullname, dbx_path, subfolder, name):
+    def upload_file(self, fullname, dbx_path, subfolder, name, chunk_size=CHUNK_SIZE, max_workers=None):
         """
         Upload a file
+
+        Large files are uploaded in chunks of chunk_size bytes, with up to
+        max_workers chunks in flight at once
         """
-        path = '/%s/%s/%s' % (dbx_path,
-                              subfolder.replace(os.path.sep, '/'), name)
-        while '//' in path:
-            path = path.replace('//', '/')
+        path = remote_path(dbx_path, subfolder, name)
 
         mode = dropbox.files.WriteMode.overwrite
         mtime = os.path.getmtime(fullname)
@@ -102,53 +219,255 @@ class Dropbox(DataService):
                 try:
                     logging.info(
                         "Uploading '{}' in a single request ".format(fullname))
-                    self.client.files_upload(
-                        f.read(), path, mode,
-                        client_modified=datetime.datetime(
-                            *time.gmtime(mtime)[:6]),
-                        mute=True)
+                    self.rate.call(self.client.files_upload,
+                                   f.read(), path, mode,
+                                   client_modified=datetime.datetime(
+                                       *time.gmtime(mtime)[:6]),
+                                   mute=True)
                 except dropbox.exceptions.ApiError as e:
                     utils.print_string("Could not upload file '{}': {}".format(
                         path, e), utils.PrintStyle.ERROR)
                     sys.exit()
 
-            # Use chunked upload
+            # Use chunked upload, with several chunks in flight at once
             else:
                 try:
                     logging.info(
                         "Uploading '{}' in chunks ".format(fullname))
-                    uploader = self.client.files_upload_session_start(
-                        f.read(CHUNK_SIZE))
+                    session_id = self.rate.call(
+                        self.client.files_upload_session_start,
+                        b'', session_type=dropbox.files.UploadSessionType.concurrent).session_id
+                    self.append_file(fullname, session_id,
+                                     chunk_size, max_workers or self.max_workers)
                     cursor = dropbox.files.UploadSessionCursor(
-                        session_id=uploader.session_id, offset=f.tell())
+                        session_id=session_id, offset=file_size)
                     commit = dropbox.files.CommitInfo(path=path)
-                    while f.tell() < file_size:
-                        try:
-                            current_offset = f.tell()
-                            if (file_size - f.tell()) <= CHUNK_SIZE:
-                                self.client.files_upload_session_finish(
-                                    f.read(CHUNK_SIZE), cursor, commit)
-                            else:
-                                self.client.files_upload_session_append_v2(
-                                    f.read(CHUNK_SIZE), cursor)
-                                cursor.offset = f.tell()
-
-                        # Attempt to resume failed upload session
-                        except requests.exceptions.ConnectionError as e:
-                            f.seek(current_offset)
-                            cursor.offset = current_offset
+                    self.rate.call(self.client.files_upload_session_finish, b'', cursor, commit)
                 except dropbox.exceptions.ApiError as e:
                     utils.print_string("Could not upload file '{}' in chunks: {}".format(
                         path, e), utils.PrintStyle.ERROR)
                     sys.exit()
 
+        record_transfer(file_size)
         utils.print_string("Successfully uploaded '{}'".format(
             fullname), utils.PrintStyle.SUCCESS)
 
-    def upload(self, rootdir, dbx_path):
+    def append_chunk(self, fullname, session_id, offset, size, close=False):
+        """
+        Append size bytes of a local file, starting at offset, to an upload session
+
+        The chunk is only read once the rate controller lets the call through,
+        so threads waiting for their turn don't hold their chunks in memory
+        """
+        cursor = dropbox.files.UploadSessionCursor(
+            session_id=session_id, offset=offset)
+
+        def append():
+            with open(fullname, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read(size)
+            self.client.files_upload_session_append_v2(chunk, cursor, close=close)
+            return len(chunk)
+        return self.rate.call(append)
+
+    def append_file(self, fullname, session_id, chunk_size=CHUNK_SIZE, max_workers=1):
+        """
+        Append the content of a local file to a concurrent upload session,
+        closing the session with the last chunk
+
+        All chunks except the last are appended with up to max_workers in
+        flight at once. The last chunk closes the session, so it is only
+        sent once every other chunk has landed
+
+        Return the number of bytes uploaded
+        """
+        if chunk_size % CHUNK_ALIGNMENT != 0:
+            raise ValueError("Chunk size must be a multiple of {} bytes".format(
+                CHUNK_ALIGNMENT))
+        if chunk_size > MAX_CHUNK_SIZE:
+            raise ValueError("Chunk size must be at most {} bytes".format(
+                MAX_CHUNK_SIZE))
+
+        file_size = os.path.getsize(fullname)
+        offsets = list(range(0, file_size, chunk_size)) or [0]
+        last = offsets.pop()
+
+        def append(offset):
+            return self.append_chunk(fullname, session_id, offset, chunk_size)
+
+        for offset, size, e in run_concurrently(append, offsets, max_workers):
+            if e is not None:
+                raise e
+            logging.info("Uploaded chunk at offset {:.0f} MB of '{}'".format(
+                offset / MB, fullname))
+        self.append_chunk(fullname, session_id, last, file_size - last, close=True)
+        return file_size
+
+    def finish_batch(self, entries):
+        """
+        Commit closed upload sessions with a single finish batch job,
+        polling the job until it completes
+
+        Return the list of per-entry results
+        """
+        launch = self.rate.call(self.client.files_upload_session_finish_batch, entries)
+        return self.wait_for_batch(
+            launch, self.client.files_upload_session_finish_batch_check).entries
+
+    def wait_for_batch(self, launch, check):
+        """
+        Return the result of a batch job
+
+        Jobs that didn't complete straight away are polled with check until
+        they do
+        """
+        if launch.is_complete():
+            return launch.get_complete()
+        if not launch.is_async_job_id():
+            raise BatchJobError("Batch job could not be started: {}".format(launch))
+
+        job_id = launch.get_async_job_id()
+        while True:
+            status = self.rate.call(check, job_id)
+            if status.is_complete():
+                return status.get_complete()
+            if not status.is_in_progress():
+                raise BatchJobError("Batch job '{}' failed: {}".format(job_id, status))
+            logging.info("Waiting for batch job '{}'".format(job_id))
+            time.sleep(POLL_INTERVAL)
+
+    def run_batch(self, names, summary, launch, check):
+        """
+        Start a delete, copy or move batch job with launch, wait for it and
+        record the outcome of every entry in summary
+        """
+        try:
+            result = self.wait_for_batch(launch(), check)
+        except (dropbox.exceptions.ApiError, BatchJobError) as e:
+            for name in names:
+                summary.add_failure(name, e)
+            return
+
+        for name, entry in zip(names, result.entries):
+            if entry.is_success():
+                summary.add_success(name)
+            elif entry.is_failure():
+                summary.add_failure(name, entry.get_failure())
+            else:
+                summary.add_failure(name, entry)
+
+    def upload_batch(self, jobs, summary, chunk_size=CHUNK_SIZE, max_workers=None):
+        """
+        Upload a batch of (local path, Dropbox path) pairs
+
+        Every file gets its own upload session, up to max_workers files are
+        appended concurrently, and all files are then committed together, so
+        the namespace lock is taken once per batch instead of once per file.
+        The chunks of each file are appended one at a time, so that at most
+        max_workers chunks are held in memory
+        """
+        max_workers = max_workers or self.max_workers
+        session_ids = self.rate.call(
+            self.client.files_upload_session_start_batch,
+            len(jobs), session_type=dropbox.files.UploadSessionType.concurrent).session_ids
+
+        def append(job):
+            fullname, path, session_id = job
+            logging.info("Uploading file '{}' ...".format(fullname))
+            return self.append_file(fullname, session_id, chunk_size)
+
+        committed = []
+        entries = []
+        jobs = [job + (session_id,) for job, session_id in zip(jobs, session_ids)]
+        for (fullname, path, session_id), size, e in run_concurrently(append, jobs, max_workers):
+            if e is not None:
+                summary.add_failure(fullname, e)
+                continue
+
+            mtime = os.path.getmtime(fullname)
+            commit = dropbox.files.CommitInfo(
+                path=path, mode=dropbox.files.WriteMode.overwrite,
+                client_modified=datetime.datetime(*time.gmtime(mtime)[:6]),
+                mute=True)
+            cursor = dropbox.files.UploadSessionCursor(
+                session_id=session_id, offset=size)
+            committed.append((fullname, size))
+            entries.append(dropbox.files.UploadSessionFinishArg(
+                cursor=cursor, commit=commit))
+
+        if not entries:
+            return
+
+        try:
+            results = self.finish_batch(entries)
+        except dropbox.exceptions.ApiError as e:
+            for fullname, size in committed:
+                summary.add_failure(fullname, e)
+            return
+
+        for (fullname, size), result in zip(committed, results):
+            if result.is_success():
+                summary.add_success(fullname, size)
+            else:
+                summary.add_failure(fullname, result.get_failure())
+
+    def upload_jobs(self, rootdir, dbx_path):
+        """
+        Walk local directory and yield a (local path, Dropbox path) pair for
+        every file that should be uploaded
+        """
+        for dn, dirs, files in os.walk(rootdir):
+            subfolder = dn[len(rootdir):].strip(SEPARATOR)
+            if subfolder != '':
+                logging.info("Descending into '{}' ...".format(subfolder))
+
+            # First do all the files
+            for name in files:
+                fullname = os.path.join(dn, name)
+                if name.startswith('.'):
+                    logging.info('Skipping dot file: {}'.format(name))
+                elif name.startswith('@') or name.endswith('~'):
+                    logging.info(
+                        'Skipping temporary file: {}'.format(name))
+                elif name.endswith('.pyc') or name.endswith('.pyo'):
+                    logging.info(
+                        'Skipping generated file: {}'.format(name))
+                else:
+                    yield fullname, remote_path(dbx_path, subfolder, name)
+
+            # Then choose which subdirectories to traverse
+            keep = []
+            for name in dirs:
+                fullname = os.path.join(dn, name)
+                if name.startswith('.'):
+                    logging.info('Skipping dot directory: {}'.format(name))
+                elif name.startswith('@') or name.endswith('~'):
+                    logging.info(
+                        'Skipping temporary directory: {}'.format(name))
+                elif name == '__pycache__':
+                    logging.info(
+                        'Skipping generated directory: {}'.format(name))
+                else:
+                    logging.info("Keeping directory:'{}'".format(fullname))
+                    keep.append(name)
+            dirs[:] = keep
+
+    def upload(self, rootdir, dbx_path, chunk_size=None, max_workers=None):
         """ 
         Upload a file or folder to Dropbox
+
+        Large files are uploaded in chunks of chunk_size bytes, and up to
+        max_workers files or chunks are uploaded concurrently
         """
+        chunk_size = chunk_size or CHUNK_SIZE
+        if chunk_size % CHUNK_ALIGNMENT != 0:
+            utils.print_string("Chunk size must be a multiple of {} MB".format(
+                CHUNK_ALIGNMENT // MB), utils.PrintStyle.ERROR)
+            return None
+        if chunk_size > MAX_CHUNK_SIZE:
+            utils.print_string("Chunk size must be at most {} MB".format(
+                MAX_CHUNK_SIZE // MB), utils.PrintStyle.ERROR)
+            return None
         rootdir = os.path.expanduser(rootdir)
         rootdir = rootdir.replace('/', SEPARATOR)
         rootdir = rootdir.rstrip(SEPARATOR)
@@ -168,64 +487,108 @@ class Dropbox(DataService):
             logging.info(rootdir + ' is a local file')
             file_name = rootdir.split(SEPARATOR)[-1]
             logging.info("Uploading file '{}' ".format(rootdir))
-            self.upload_file(rootdir, dbx_path, "", file_name)
+            self.upload_file(rootdir, dbx_path, "", file_name,
+                             chunk_size, max_workers)
 
-        # Upload folder content
+        # Upload folder content in batches of upload sessions
         elif os.path.isdir(rootdir):
             logging.info(rootdir + ' is a local directory')
             dbx_path += rootdir.split(SEPARATOR)[-1]
-            for dn, dirs, files in os.walk(rootdir):
-                subfolder = dn[len(rootdir):].strip(SEPARATOR)
-                if subfolder != '':
-                    logging.info("Descending into '{}' ...".format(subfolder))
-
-                # First do all the files
-                for name in files:
-                    fullname = os.path.join(dn, name)
-                    if name.startswith('.'):
-                        logging.info('Skipping dot file: {}'.format(name))
-                    elif name.startswith('@') or name.endswith('~'):
-                        logging.info(
-                            'Skipping temporary file: {}'.format(name))
-                    elif name.endswith('.pyc') or name.endswith('.pyo'):
-                        logging.info(
-                            'Skipping generated file: {}'.format(name))
-                    else:
-                        logging.info(
-                            "Uploading file '{}' ...".format(fullname))
-                        self.upload_file(fullname, dbx_path, subfolder, name)
-
-                # Then choose which subdirectories to traverse
-                keep = []
-                for name in dirs:
-                    fullname = os.path.join(dn, name)
-                    if name.startswith('.'):
-                        logging.info('Skipping dot directory: {}'.format(name))
-                    elif name.startswith('@') or name.endswith('~'):
-                        logging.info(
-                            'Skipping temporary directory: {}'.format(name))
-                    elif name == '__pycache__':
-                        logging.info(
-                            'Skipping generated directory: {}'.format(name))
-                    else:
-                        logging.info("Keeping directory:'{}'".format(fullname))
-                        keep.append(name)
-                dirs[:] = keep
+
+            summary = TransferSummary()
+            for jobs in chunked(self.upload_jobs(rootdir, dbx_path), UPLOAD_BATCH_SIZE):
+                try:
+                    self.upload_batch(jobs, summary, chunk_size, max_workers)
+                except dropbox.exceptions.ApiError as e:
+                    for fullname, path in jobs:
+                        summary.add_failure(fullname, e)
+            if not summary.report("Uploaded"):
+                return None
 
         utils.print_string('All uploads successfull', utils.PrintStyle.SUCCESS)
 
-    def delete(self, dbx_path):
-        dbx_path = dbx_path.replace('\\', '/')
-        dbx_path = '/' + dbx_path.lstrip('/')
-        try:
-            md = self.client.files_delete(dbx_path)
-        except dropbox.exceptions.ApiError as err:
-            utils.print_string(
-                "Could not delete '{}': {}".format(dbx_path, err), utils.PrintStyle.ERROR)
+    def delete(self, dbx_paths):
+        """
+        Delete one or more files or folders
+
+        Several paths are deleted server-side in batch jobs of up to
+        OPERATION_BATCH_SIZE entries each
+        """
+        if isinstance(dbx_paths, str):
+            dbx_paths = [dbx_paths]
+        dbx_paths = [normalize_path(path) for path in dbx_paths]
+
+        if len(dbx_paths) == 1:
+            try:
+                md = self.rate.call(self.client.files_delete, dbx_paths[0])
+            except dropbox.exceptions.ApiError as err:
+                utils.print_string(
+                    "Could not delete '{}': {}".format(dbx_paths[0], err), utils.PrintStyle.ERROR)
+                return None
+
+            utils.print_string("Successfully deleted {}".format(
+                md.name), utils.PrintStyle.SUCCESS)
+            return
+
+        summary = TransferSummary()
+        for paths in chunked(dbx_paths, OPERATION_BATCH_SIZE):
+            logging.info("Deleting {} paths".format(len(paths)))
+            entries = [dropbox.files.DeleteArg(path) for path in paths]
+            self.run_batch(
+                paths, summary,
+                lambda: self.rate.call(self.client.files_delete_batch, entries),
+                self.client.files_delete_batch_check)
+        if not summary.report("Deleted"):
             return None
 
-        utils.print_string("Successfully deleted {}".format(
-            md.name), utils.PrintStyle.SUCCESS)
+        utils.print_string("Successfully deleted {} items".format(
+            len(dbx_paths)), utils.PrintStyle.SUCCESS)
+
+    def relocate(self, dbx_paths, dest_path, move=False):
+        """
+        Copy or move files and folders into the Dropbox folder dest_path,
+        in batch jobs of up to OPERATION_BATCH_SIZE entries each
+        """
+        if isinstance(dbx_paths, str):
+            dbx_paths = [dbx_paths]
+        dest_path = normalize_path(dest_path).rstrip('/')
+        pairs = [(path, '{}/{}'.format(dest_path, path.split('/')[-1]))
+                 for path in map(normalize_path, dbx_paths)]
+
+        if move:
+            action = "Moved"
+            batch = self.client.files_move_batch_v2
+            check = self.client.files_move_batch_check_v2
+        else:
+            action = "Copied"
+            batch = self.client.files_copy_batch_v2
+            check = self.client.files_copy_batch_check_v2
+
+        summary = TransferSummary()
+        for chunk in chunked(pairs, OPERATION_BATCH_SIZE):
+            logging.info("{} {} paths to '{}'".format(
+                "Moving" if move else "Copying", len(chunk), dest_path or '/'))
+            entries = [dropbox.files.RelocationPath(src, dst) for src, dst in chunk]
+            self.run_batch(
+                [src for src, dst in chunk], summary,
+                lambda: self.rate.call(batch, entries), check)
+        if not summary.report(action):
+            return None
+
+        utils.print_string("{} {} items to '{}'".format(
+            action, len(pairs), dest_path or '/'), utils.PrintStyle.SUCCESS)
+
+    def copy(self, dbx_paths, dest_path):
+        """
+        Copy one or more files or folders into the folder dest_path
+        """
+        return self.relocate(dbx_paths, dest_path)
+
+    def move(self, dbx_paths, dest_path):
+        """
+        Move one or more files or folders into the folder dest_path
+        """
+        return self.relocate(dbx_paths, dest_path, move=True)
 
     def close(self):
         """
@@ -238,6 +601,42 @@ class Dropbox(DataService):
             logging.warning("Error when cleaning up Dropbox resources.")
 
 
+def classify_error(e):
+    """
+    Decide whether a failed Dropbox API call should be retried
+
+    Returns None if it shouldn't, otherwise a (throttled, retry_after) pair
+    for RateController. Rate limit errors cover both too_many_requests and
+    too_many_write_operations
+    """
+    if isinstance(e, dropbox.exceptions.RateLimitError):
+        return True, e.backoff
+    if isinstance(e, dropbox.exceptions.InternalServerError):
+        return e.status_code == 503, None
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return False, None
+    return None
+
+
+def normalize_path(dbx_path):
+    """
+    Return the given path in the form the Dropbox API expects
+    """
+    dbx_path = dbx_path.strip().replace('\\', '/')
+    return '/' + dbx_path.strip('/')
+
+
+def remote_path(dbx_path, subfolder, name):
+    """
+    Return the Dropbox path of a file inside a local subfolder
+    """
+    path = '/%s/%s/%s' % (dbx_path,
+                          subfolder.replace(os.path.sep, '/'), name)
+    while '//' in path:
+        path = path.replace('//', '/')
+    return path
+
+
 def no_redirect_oauth2():
     """
     Goes through a basic OAuth flow using a short-lived token type
@@ -278,7 +677,8 @@ def no_redirect_oauth2():
     with open('../data/dropbox_credentials.json', 'w') as file:
         json.dump(data, file)
 
-    with dropbox.Dropbox(oauth2_access_token=oauth_result.access_token, oauth2_refresh_token=oauth_result.refresh_token, app_key=data.get("app_key")) as client:
+    with dropbox.Dropbox(oauth2_access_token=oauth_result.access_token, oauth2_refresh_token=oauth_result.refresh_token, app_key=data.get("app_key"),
+                         max_retries_on_rate_limit=0) as client:
         client.users_get_current_account()
         utils.print_string("Authentication successful!",
                            utils.PrintStyle.SUCCESS)
@@ -298,7 +698,8 @@ def authenticate():
     if "access_token" in data and "refresh_token" in data:
         try:
             client = dropbox.Dropbox(oauth2_access_token=data.get(
-                "access_token"), oauth2_refresh_token=data.get("refresh_token"), app_key=data.get("app_key"))
+                "access_token"), oauth2_refresh_token=data.get("refresh_token"), app_key=data.get("app_key"),
+                max_retries_on_rate_limit=0)
             client.users_get_current_account()
         except dropbox.exceptions.AuthError as e:
             utils.print_string(
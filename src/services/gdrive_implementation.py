@@ -1,14 +1,21 @@
+import contextlib
 import io
 import logging
 import os
+import queue
 import sys
+import threading
+import time
+from services.backoff import RateController, parse_retry_after
 from services.data_service import DataService
+from services.transfer import MAX_WORKERS, RANGED_THRESHOLD, TransferSummary, ranged_download, record_transfer, run_concurrently
 import utils
+import google_auth_httplib2
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.discovery import Resource
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 
@@ -19,23 +26,179 @@ MB = 1024 * 1024
 CHUNK_SIZE = 32 * MB
 THRESHOLD = 32 * MB
 SEPARATOR = os.path.sep
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+# Maximum number of calls the Drive API accepts in a single batch request
+BATCH_SIZE = 100
+
+# Maximum number of ids files.generateIds returns per call
+GENERATE_IDS_SIZE = 1000
+
+# Maximum number of parent folders ORed into a single listing query
+PARENTS_PER_QUERY = 50
+
+# Error reasons Drive uses when a user or project exceeds its rate limit
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+
+class DriveBatch:
+    """
+    Collects Drive API requests and sends them through the batch endpoint,
+    grouping up to BATCH_SIZE calls in each HTTP request
+    """
+
+    def __init__(self, clients, rate):
+        self.clients = clients
+        self.rate = rate
+        self.requests = []
+
+    def add(self, key, request):
+        """
+        Queue request, identifying its outcome with the given key
+        """
+        self.requests.append((key, request))
+
+    def execute(self):
+        """
+        Execute all queued requests
+
+        Calls of a batch fail one by one. Calls that failed with an error
+        the rate controller would retry are queued again and sent in the
+        next batch after backing off, up to its max_retries times
+
+        Return a dict mapping each key to a (response, error) pair, where
+        error is the HttpError raised for that call, if any
+        """
+        results = {}
+        pending = self.requests
+        attempt = 0
+        while pending:
+            retry = []
+            throttled = False
+            retry_after = None
+
+            def callback(request_id, response, exception, chunk):
+                nonlocal throttled, retry_after
+                key, request = chunk[int(request_id)]
+                decision = None
+                if exception is not None and attempt < self.rate.max_retries:
+                    decision = self.rate.classify(exception)
+                if decision is None:
+                    results[key] = (response, exception)
+                    return
+                retry.append((key, request))
+                throttled = throttled or decision[0]
+                if decision[1] is not None:
+                    retry_after = max(retry_after or 0, decision[1])
+
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[start:start + BATCH_SIZE]
+                batch = self.clients.client.new_batch_http_request(
+                    callback=lambda *args, chunk=chunk: callback(*args, chunk))
+                for i, (key, request) in enumerate(chunk):
+                    batch.add(request, request_id=str(i))
+                logging.info("Sending batch of {} Drive requests".format(len(chunk)))
+                with self.clients.http() as http:
+                    self.rate.call(batch.execute, http=http)
+
+            if retry:
+                if throttled:
+                    self.rate.on_throttle()
+                delay = self.rate.delay(attempt, retry_after)
+                logging.warning("Retrying {} Drive batch calls in {:.2f} seconds ({}/{})".format(
+                    len(retry), delay, attempt + 1, self.rate.max_retries))
+                time.sleep(delay)
+                attempt += 1
+            pending = retry
+        self.requests = []
+        return results
 
 
 class Gdrive(DataService):
-    def __init__(self):
-        self.client = authenticate_OAuth2()
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.clients = authenticate_OAuth2(max_workers)
+        self.max_workers = max_workers
+        self.rate = RateController('Google Drive', classify_error, max_workers)
+
+        # Maps (path components, is folder) to the id of the item at that path
+        self.path_cache = {}
+        self.cache_lock = threading.Lock()
+
+    def reset_caches(self):
+        with self.cache_lock:
+            self.path_cache.clear()
+
+    @property
+    def client(self):
+        """
+        Drive client used to build requests, which are executed on a
+        connection checked out of the pool
+        """
+        return self.clients.client
+
+    def reserve(self, max_workers):
+        """
+        Make room for max_workers concurrent calls, opening more connections
+        and allowing more calls in flight if the service was created with
+        fewer workers
+        """
+        if max_workers:
+            self.clients.grow(max_workers)
+            self.rate.grow(max_workers)
+
+    def execute(self, request):
+        """
+        Execute a single Drive API request, retrying it on rate limits and
+        transient errors
+        """
+        with self.clients.http() as http:
+            return self.rate.call(request.execute, http=http)
+
+    def create_folders(self, names, parent_id):
+        """
+        Create folders with the given names inside the specified parent folder
+        using batch requests
+
+        Return a dict mapping each name to a (folder id, error) pair
+        """
+        batch = DriveBatch(self.clients, self.rate)
+        for name in names:
+            logging.info("Creating Google Drive subdirectory '{}'".format(name))
+            metadata = {
+                'name': name,
+                'mimeType': FOLDER_MIMETYPE,
+                'parents': [parent_id]
+            }
+            batch.add(name, self.client.files().create(body=metadata, fields='id'))
+
+        results = {}
+        for name, (response, error) in batch.execute().items():
+            results[name] = (response.get('id') if error is None else None, error)
+        return results
+
+    def delete_items(self, ids):
+        """
+        Delete the items with the given ids using batch requests
+
+        Return a dict mapping each id to the error raised while deleting it,
+        or None if it was deleted
+        """
+        batch = DriveBatch(self.clients, self.rate)
+        for id in ids:
+            batch.add(id, self.client.files().delete(fileId=id))
+        return {id: error for id, (response, error) in batch.execute().items()}
 
     def get_path(self, id):
         """
         Return absolute path of Google Drive file or folder with the given id
         """
         try:
-            object = self.client.files().get(fileId=id, fields='id, name, parents').execute()
+            object = self.execute(self.client.files().get(fileId=id, fields='id, name, parents'))
             parent = object.get('parents')
             path = object.get('name')
             while parent is not None:
-                folder = self.client.files().get(
-                    fileId=parent[0], fields='id, name, parents').execute()
+                folder = self.execute(self.client.files().get(
+                    fileId=parent[0], fields='id, name, parents'))
                 path = folder.get('name') + SEPARATOR + path
                 parent = folder.get('parents')
             return path
@@ -46,37 +209,39 @@ class Gdrive(DataService):
     def exists(self, folder_id, key, key_is_folder=False):
         """
         If key exists inside specified folder, return its id, otherwise return None
+
+        The name and type are matched server-side, so only matching items
+        are returned instead of the whole folder listing
         """
+        if key_is_folder:
+            type_clause = "mimeType = '{}'".format(FOLDER_MIMETYPE)
+        else:
+            type_clause = "mimeType != '{}'".format(FOLDER_MIMETYPE)
+        query = "name = '{}' and '{}' in parents and {} and trashed = false".format(
+            escape_query(key), folder_id, type_clause)
+
         try:
-            files = []
-            page_token = None
-            while True:
-                response = self.client.files().list(q="'" + folder_id + "' in parents and trashed = false",
-                                                    spaces='drive', fields='nextPageToken, files(id, name, mimeType)',
-                                                    pageToken=page_token).execute()
-                files.extend(response.get('files', []))
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
+            response = self.execute(self.client.files().list(q=query, spaces='drive', pageSize=1,
+                                                             fields='files(id, mimeType)'))
         except HttpError as e:
             utils.print_string("Error while listing contents of '{}' : {}".format(
                 folder_id, e), utils.PrintStyle.ERROR)
             sys.exit()
 
-        for item in files:
-            if item.get('name') == key:
-                if (key_is_folder and item.get('mimeType') == 'application/vnd.google-apps.folder') or (
-                        (not key_is_folder) and item.get('mimeType') != 'application/vnd.google-apps.folder'):
-                    return item.get('id')
-        else:
-            logging.info("Not found '{}'".format(key))
-            return None
+        files = response.get('files', [])
+        if files:
+            return files[0].get('id')
+        logging.info("Not found '{}'".format(key))
+        return None
 
     def traverse(self, gd_path):
         """
         Traverse Google Drive directory structure based on given path,
 
         Return the id and type of the item at the end of the path
+
+        Resolved path prefixes are cached, so later lookups under the same
+        directory don't hit the API again
         """
         gd_path = gd_path.replace('/', SEPARATOR)
         if gd_path.endswith(SEPARATOR):
@@ -98,11 +263,22 @@ class Gdrive(DataService):
 
         current_folder_id = 'root'
         names = gd_path.split(SEPARATOR)
-        for item in names:
+        for i, item in enumerate(names):
+            at_final_item = i == len(names) - 1
+            key_is_folder = is_folder if at_final_item else True
+
+            cache_key = (tuple(names[:i + 1]), key_is_folder)
+            with self.cache_lock:
+                id = self.path_cache.get(cache_key)
+            if id is None:
+                id = self.exists(current_folder_id, item, key_is_folder)
+                if id is not None:
+                    with self.cache_lock:
+                        self.path_cache[cache_key] = id
+
             # Reached final item, return its id if it exists on Google Drive
-            if item == names[-1]:
+            if at_final_item:
                 logging.info("At final item")
-                id = self.exists(current_folder_id, item, is_folder)
                 if id is not None:
                     return id, is_folder
                 else:
@@ -110,7 +286,6 @@ class Gdrive(DataService):
                         key_type, item), utils.PrintStyle.ERROR)
                     sys.exit()
             else:
-                id = self.exists(current_folder_id, item, True)
                 if id is not None:
                     current_folder_id = id
                 else:
@@ -118,113 +293,192 @@ class Gdrive(DataService):
                         item), utils.PrintStyle.ERROR)
                     sys.exit()
 
-    def download_file(self, localdir, file_id, old_downloader=None):
+    def forget_path(self, gd_path):
+        """
+        Drop cached ids of the given path and everything below it
+        """
+        names = tuple(gd_path.replace('/', SEPARATOR).strip(SEPARATOR)
+                      .removeprefix('My Drive').strip(SEPARATOR).split(SEPARATOR))
+        with self.cache_lock:
+            for cache_key in list(self.path_cache):
+                if cache_key[0][:len(names)] == names:
+                    del self.path_cache[cache_key]
+
+    def download_range(self, file_id, start, end):
+        """
+        Return the bytes of a Google Drive file in the inclusive range [start, end]
+        """
+        request = self.client.files().get_media(fileId=file_id)
+        request.headers['Range'] = 'bytes={}-{}'.format(start, end)
+        return self.execute(request)
+
+    def download_file(self, localdir, file_id, file=None, restart=True):
         """
         Download Google Drive file
+
+        If the file's metadata (id, name, mimeType and size) is already
+        known, pass it as file to skip fetching it again
+
+        Returns the number of bytes written, or None if the download failed
         """
+        file_name = file_id
         try:
-            if old_downloader is None:
-                file = self.client.files().get(fileId=file_id, fields='id, name, mimeType').execute()
-                file_name = file.get('name')
-                file_mimeType = file.get('mimeType')
-
-                # Download Google Workspace document as PDF
-                if file_mimeType.startswith("application/vnd.google-apps") and not file_mimeType.endswith(
-                        "script+json"):
-                    logging.info(
-                        "Initiating resumable download of Google Workspace Document '{}'".format(file_name))
-                    request = self.client.files().export_media(
-                        fileId=file_id, mimeType='application/pdf')
-                    file_name += ".pdf"
-
-                # Download Blob (text or binary) files
-                else:
-                    logging.info(
-                        "Initiating resumable download of Blob '{}'".format(file_name))
-                    request = self.client.files().get_media(fileId=file_id)
+            if file is None:
+                file = self.execute(self.client.files().get(fileId=file_id, fields='id, name, mimeType, size'))
+            file_name = file.get('name')
+            file_mimeType = file.get('mimeType')
+            file_size = int(file.get('size', 0))
+
+            # Download Google Workspace document as PDF
+            if file_mimeType.startswith("application/vnd.google-apps") and not file_mimeType.endswith(
+                    "script+json"):
+                logging.info(
+                    "Initiating resumable download of Google Workspace Document '{}'".format(file_name))
+                request = self.client.files().export_media(
+                    fileId=file_id, mimeType='application/pdf')
+                file_name += ".pdf"
 
+            # Download large Blob files in concurrent byte ranges
+            elif file_size > RANGED_THRESHOLD:
+                logging.info(
+                    "Initiating ranged download of Blob '{}'".format(file_name))
                 file_path = os.path.join(localdir, file_name)
-                f = io.FileIO(file_path, mode='wb')
-                logging.info("Downloading to {}".format(file_path))
-                downloader = MediaIoBaseDownload(f, request)
+                ranged_download(lambda start, end: self.download_range(file_id, start, end),
+                                file_size, file_path, max_workers=self.max_workers)
+                utils.print_string("File '{}' downloaded successfully".format(
+                    file_name), utils.PrintStyle.SUCCESS)
+                return file_size
+
+            # Download Blob (text or binary) files
             else:
-                logging.info("Resuming download of '{}'".format(file_name))
-                downloader = old_downloader
+                logging.info(
+                    "Initiating resumable download of Blob '{}'".format(file_name))
+                request = self.client.files().get_media(fileId=file_id)
+
+            file_path = os.path.join(localdir, file_name)
+            logging.info("Downloading to {}".format(file_path))
 
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                if status:
-                    utils.print_string("Downloaded %d%%." % int(
-                        status.progress() * 100), utils.PrintStyle.INFO)
+            # The downloader sends every chunk on the connection of its
+            # request, which is held until the download is done. Failed
+            # chunks are retried, resuming the download where it stopped
+            with self.clients.http() as http, io.FileIO(file_path, mode='wb') as f:
+                request.http = http
+                downloader = MediaIoBaseDownload(f, request)
+                done = False
+                while done is False:
+                    status, done = self.rate.call(downloader.next_chunk)
+                    if status:
+                        utils.print_string("Downloaded %d%%." % int(
+                            status.progress() * 100), utils.PrintStyle.INFO)
 
             utils.print_string("File '{}' downloaded successfully".format(
                 file_name), utils.PrintStyle.SUCCESS)
+            return os.path.getsize(file_path)
         except HttpError as e:
-            if e.resp.status in [404]:
-                # Restart the download
-                self.download_file(localdir, file_id=file_id)
-            elif e.resp.status in [500, 502, 503, 504]:
-                # Resume download
-                self.download_file(localdir, file_id=file_id,
-                                   old_downloader=downloader)
+            if e.resp.status in [404] and restart:
+                # Restart the download, once
+                return self.download_file(localdir, file_id=file_id, restart=False)
             else:
                 utils.print_string("Could not download file '{}': {}".format(
                     file_name, e), utils.PrintStyle.ERROR)
                 sys.exit()
 
-    def download_directory(self, localdir, folder_id):
+    def crawl(self, localdir, folder_id, folder_name):
         """
-        Download contents of Google Drive directory
+        Crawl Google Drive folder breadth-first, creating its directory tree
+        inside localdir
+
+        The children of up to PARENTS_PER_QUERY folders are listed with a
+        single query. Yield a (local directory, file metadata) pair for every
+        file as soon as it is discovered
         """
-        try:
-            items = []
-            page_token = None
-            while True:
-                response = self.client.files().list(q="'" + folder_id + "' in parents and trashed = false",
-                                                    spaces='drive', fields='nextPageToken, files(id, name, mimeType)',
-                                                    pageToken=page_token).execute()
-                items.extend(response.get('files', []))
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
-        except HttpError as e:
-            utils.print_string("Error while listing contents of '{}' : {}".format(
-                folder_id, e), utils.PrintStyle.ERROR)
-            sys.exit()
+        root = os.path.join(localdir, folder_name)
+        os.makedirs(root, exist_ok=True)
 
-        current_folder_name = self.client.files().get(
-            fileId=folder_id, fields='id, name').execute().get('name')
+        # Folder ids of the current level, mapped to their local paths
+        level = {folder_id: root}
+        while level:
+            next_level = {}
+            ids = list(level)
+            for start in range(0, len(ids), PARENTS_PER_QUERY):
+                parents = " or ".join(
+                    "'{}' in parents".format(id) for id in ids[start:start + PARENTS_PER_QUERY])
+                query = "({}) and trashed = false".format(parents)
+                try:
+                    page_token = None
+                    while True:
+                        response = self.execute(self.client.files().list(q=query, spaces='drive', pageSize=1000,
+                                                                         fields='nextPageToken, files(id, name, mimeType, size, parents)',
+                                                                         pageToken=page_token))
+                        for item in response.get('files', []):
+                            parent = next(id for id in item.get('parents') if id in level)
+                            path = os.path.join(level[parent], item.get('name'))
+                            name = item.get('name')
 
-        logging.info("Downloading contents of directory '{}'".format(
-            current_folder_name))
+                            # Item is a directory
+                            if item.get('mimeType') == FOLDER_MIMETYPE:
+                                next_level[item.get('id')] = path
 
-        for item in items:
-            # Create directory locally, if it doesn't exist
-            path = os.path.join(localdir, current_folder_name)
-            if not os.path.isdir(path):
-                os.makedirs(path)
+                            # Item is a file
+                            elif name.startswith('.'):
+                                logging.info('Skipping dot file: ' + name)
+                            elif name.startswith('@') or name.endswith('~'):
+                                logging.info('Skipping temporary file: ' + name)
+                            elif name.endswith('.pyc') or name.endswith('.pyo'):
+                                logging.info('Skipping generated file: ' + name)
+                            else:
+                                yield level[parent], item
+                        page_token = response.get('nextPageToken', None)
+                        if page_token is None:
+                            break
+                except HttpError as e:
+                    utils.print_string("Error while listing contents of '{}' : {}".format(
+                        folder_name, e), utils.PrintStyle.ERROR)
+                    sys.exit()
 
-            # Item is a directory
-            if item.get('mimeType') == "application/vnd.google-apps.folder":
-                self.download_directory(path, item.get('id'))
+            # Materialize the next level of the local directory tree
+            for path in next_level.values():
+                logging.info("Creating local directory '{}'".format(path))
+                os.makedirs(path, exist_ok=True)
+            level = next_level
+
+    def download_directory(self, localdir, folder_id, folder_name=None, max_workers=None):
+        """
+        Download contents of Google Drive directory
 
-            # Item is a file
+        Files are queued for a pool of max_workers download workers as soon
+        as the crawl discovers them
+
+        Returns true if all files were downloaded, otherwise returns false
+        """
+        if folder_name is None:
+            folder_name = self.execute(self.client.files().get(
+                fileId=folder_id, fields='id, name')).get('name')
+
+        logging.info("Downloading contents of directory '{}'".format(
+            folder_name))
+
+        def download_job(job):
+            path, item = job
+            self.download_file(path, item.get('id'), file=item)
+            return int(item.get('size', 0))
+
+        summary = TransferSummary()
+        jobs = self.crawl(localdir, folder_id, folder_name)
+        for (path, item), size, e in run_concurrently(download_job, jobs, max_workers or self.max_workers):
+            if e is None:
+                summary.add_success(item.get('name'), size)
             else:
-                name = item.get('name')
-                if name.startswith('.'):
-                    logging.info('Skipping dot file: ' + name)
-                elif name.startswith('@') or name.endswith('~'):
-                    logging.info('Skipping temporary file: ' + name)
-                elif name.endswith('.pyc') or name.endswith('.pyo'):
-                    logging.info('Skipping generated file: ' + name)
-                else:
-                    self.download_file(path, item.get('id'))
+                summary.add_failure(os.path.join(path, item.get('name')), e)
+        return summary.report("Downloaded")
 
-    def download(self, localdir, gd_path):
+    def download(self, localdir, gd_path, max_workers=None):
         """
         Download Google Drive file or directory
+
+        Up to max_workers files are downloaded concurrently
         """
+        self.reserve(max_workers)
         localdir = os.path.expanduser(localdir)
         localdir = localdir.replace('/', SEPARATOR)
         localdir = localdir.rstrip(SEPARATOR)
@@ -235,7 +489,7 @@ class Gdrive(DataService):
 
         # Get item that will be downloaded
         id, is_folder = self.traverse(gd_path)
-        item = self.client.files().get(fileId=id).execute()
+        item = self.execute(self.client.files().get(fileId=id))
 
         logging.info("Local directory: " + localdir)
         logging.info("Google Drive path: " + gd_path)
@@ -243,9 +497,12 @@ class Gdrive(DataService):
         try:
             # Download directory
             if item.get('mimeType') == "application/vnd.google-apps.folder":
-                self.download_directory(localdir, item.get('id'))
+                if not self.download_directory(localdir, item.get('id'), item.get('name'), max_workers):
+                    return None
             else:
-                self.download_file(localdir, item.get('id'))
+                size = self.download_file(localdir, item.get('id'))
+                if size is not None:
+                    record_transfer(size)
         except HttpError as e:
             utils.print_string("Could not download '{}' : {}".format(
                 gd_path, e), utils.PrintStyle.ERROR)
@@ -253,13 +510,16 @@ class Gdrive(DataService):
 
         utils.print_string("All downloads ok", utils.PrintStyle.SUCCESS)
 
-    def upload_file(self, localdir, folder_id='root', file_id=None, old_request=None):
+    def upload_file(self, localdir, folder_id='root', file_id=None, old_request=None, new_id=None, restart=True):
         """
         Upload file if it doesn't exist
 
-        If the file already exists, update it
+        If the file already exists, update it. New files are created with
+        new_id, if a pre-allocated id is given
 
         Use resumable upload for large files
+
+        Return the id of the uploaded file
         """
         file_size = os.path.getsize(localdir)
         if file_size > THRESHOLD:
@@ -281,6 +541,8 @@ class Gdrive(DataService):
                     logging.info("Uploading new file '{}'".format(
                         localdir.split(SEPARATOR)[-1]))
                     metadata['parents'] = [folder_id]
+                    if new_id is not None:
+                        metadata['id'] = new_id
                     request = self.client.files().create(body=metadata, media_body=media)
                 else:
                     logging.info("Updating file '{}'".format(
@@ -292,38 +554,254 @@ class Gdrive(DataService):
                 logging.info("Resuming upload/update of '{}'".format(localdir))
 
             if resumable:
+                # Failed chunks are retried, resuming the upload where it stopped
                 response = None
-                while response is None:
-                    status, response = request.next_chunk()
-                    if status:
-                        utils.print_string("Uploaded %d%%." % int(
-                            status.progress() * 100), utils.PrintStyle.INFO)
+                with self.clients.http() as http:
+                    while response is None:
+                        status, response = self.rate.call(request.next_chunk, http=http)
+                        if status:
+                            utils.print_string("Uploaded %d%%." % int(
+                                status.progress() * 100), utils.PrintStyle.INFO)
             else:
-                request.execute()
+                response = self.execute(request)
 
             utils.print_string("File '{}' uploaded successfully".format(
                 localdir), utils.PrintStyle.SUCCESS)
+            return response.get('id')
         except HttpError as e:
-            if e.resp.status in [404]:
-                # Restart the upload
-                self.upload_file(
-                    localdir, folder_id=folder_id, file_id=file_id)
-            elif e.resp.status in [500, 502, 503, 504]:
-                # Resume upload
-                if resumable:
-                    self.upload_file(localdir, folder_id=folder_id,
-                                     file_id=file_id, old_request=request)
-                else:
-                    sys.exit()
+            if e.resp.status in [404] and restart:
+                # Upload session expired, restart the upload once
+                return self.upload_file(
+                    localdir, folder_id=folder_id, file_id=file_id, new_id=new_id, restart=False)
             else:
                 utils.print_string("Could not upload file '{}': {}".format(
                     localdir, e), utils.PrintStyle.ERROR)
                 sys.exit()
 
-    def upload(self, localdir, gd_path):
+    def list_folder(self, folder_id):
+        """
+        List the contents of a Google Drive folder once
+
+        Return a dict mapping (name, is folder) to the id of each item
+        """
+        items = {}
+        try:
+            page_token = None
+            while True:
+                response = self.execute(self.client.files().list(q="'" + folder_id + "' in parents and trashed = false",
+                                                                 spaces='drive', fields='nextPageToken, files(id, name, mimeType)',
+                                                                 pageSize=1000, pageToken=page_token))
+                for item in response.get('files', []):
+                    is_folder = item.get('mimeType') == FOLDER_MIMETYPE
+                    items.setdefault((item.get('name'), is_folder), item.get('id'))
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    break
+        except HttpError as e:
+            utils.print_string("Error while listing contents of '{}' : {}".format(
+                folder_id, e), utils.PrintStyle.ERROR)
+            sys.exit()
+        return items
+
+    def create_folder(self, name, parent_id):
+        """
+        Create Google Drive folder inside the specified parent folder
+
+        Return the id of the new folder, or None if it could not be created
+        """
+        logging.info("Creating Google Drive subdirectory '{}'".format(name))
+        try:
+            metadata = {
+                'name': name,
+                'mimeType': FOLDER_MIMETYPE,
+                'parents': [parent_id]
+            }
+            return self.execute(self.client.files().create(
+                body=metadata, fields='id')).get('id')
+        except HttpError as e:
+            utils.print_string("Could not create folder '{}' on Google Drive: {}".format(
+                name, e), utils.PrintStyle.ERROR)
+            return None
+
+    def generate_ids(self, count):
+        """
+        Reserve count new Google Drive file ids
+        """
+        ids = []
+        while len(ids) < count:
+            response = self.execute(self.client.files().generateIds(
+                count=min(count - len(ids), GENERATE_IDS_SIZE), space='drive', type='files'))
+            ids.extend(response.get('ids', []))
+        return ids
+
+    def walk(self, localdir):
+        """
+        Walk local directory, skipping dot, temporary and generated items
+
+        Yield (directory, subdirectories, files) tuples like os.walk, where
+        removing entries from subdirectories prunes the walk
+        """
+        for dn, dirs, files in os.walk(localdir):
+            keep_files = []
+            for name in files:
+                if name.startswith('.'):
+                    logging.info('Skipping dot file: ' + name)
+                elif name.startswith('@') or name.endswith('~'):
+                    logging.info('Skipping temporary file: ' + name)
+                elif name.endswith('.pyc') or name.endswith('.pyo'):
+                    logging.info('Skipping generated file: ' + name)
+                else:
+                    keep_files.append(name)
+
+            keep = []
+            for name in dirs:
+                if name.startswith('.'):
+                    logging.info('Skipping dot directory: ' + name)
+                elif name.startswith('@') or name.endswith('~'):
+                    logging.info('Skipping temporary directory: ' + name)
+                elif name == '__pycache__':
+                    logging.info('Skipping generated directory:' + name)
+                else:
+                    keep.append(name)
+            dirs[:] = keep
+            yield dn, dirs, keep_files
+
+    def upload_preallocated(self, localdir, parent_id, max_workers=None):
+        """
+        Upload local directory into the specified Google Drive folder, using
+        pre-allocated ids for every new folder and file
+
+        Ids are reserved in bulk with files.generateIds and assigned to the
+        whole tree up front. New folders are then created with one batch per
+        tree level and all files are uploaded concurrently, instead of waiting
+        on each folder's creation before descending into it
+
+        Returns true if everything was uploaded, otherwise returns false
+        """
+        name = localdir.split(SEPARATOR)[-1]
+
+        # Local path -> remote folder id, for folders that already exist
+        existing = {}
+        folder_id = self.exists(parent_id, name, True)
+        if folder_id is not None:
+            existing[localdir] = folder_id
+
+        # Plan the whole tree: new folders per level and (local path, parent, file id) for files
+        if folder_id is None:
+            levels = [[(localdir, os.path.dirname(localdir))]]
+        else:
+            levels = [[]]
+        files = []
+        for dn, dirs, names in self.walk(localdir):
+            depth = dn[len(localdir):].count(SEPARATOR) + 1
+            contents = self.list_folder(existing[dn]) if dn in existing else {}
+            for name in names:
+                files.append((os.path.join(dn, name), dn, contents.get((name, False))))
+            for name in dirs:
+                path = os.path.join(dn, name)
+                if (name, True) in contents:
+                    existing[path] = contents[(name, True)]
+                else:
+                    while len(levels) <= depth:
+                        levels.append([])
+                    levels[depth].append((path, dn))
+
+        # Reserve and assign ids for every new folder and file
+        new_folders = [path for level in levels for path, parent in level]
+        new_files = [path for path, parent, file_id in files if file_id is None]
+        logging.info("Reserving ids for {} folders and {} files".format(
+            len(new_folders), len(new_files)))
+        ids = iter(self.generate_ids(len(new_folders) + len(new_files)))
+        folders = dict(existing)
+        for path in new_folders:
+            folders[path] = next(ids)
+        file_ids = {path: next(ids) for path in new_files}
+
+        # Create new folders one level at a time, since parents must exist first
+        failed = set()
+        for level in levels:
+            batch = DriveBatch(self.clients, self.rate)
+            for path, parent in level:
+                if parent in failed:
+                    failed.add(path)
+                    continue
+                metadata = {
+                    'id': folders[path],
+                    'name': path.split(SEPARATOR)[-1],
+                    'mimeType': FOLDER_MIMETYPE,
+                    'parents': [folders.get(parent, parent_id)]
+                }
+                batch.add(path, self.client.files().create(body=metadata, fields='id'))
+            for path, (response, error) in batch.execute().items():
+                if error is not None:
+                    utils.print_string("Could not create folder '{}' on Google Drive: {}".format(
+                        path, error), utils.PrintStyle.ERROR)
+                    failed.add(path)
+
+        # Upload all files concurrently
+        def upload_job(job):
+            fullname, parent, file_id = job
+            return self.upload_file(fullname, folder_id=folders[parent], file_id=file_id,
+                                    new_id=file_ids.get(fullname))
+
+        summary = TransferSummary()
+        jobs = [job for job in files if job[1] not in failed]
+        for (fullname, parent, file_id), id, e in run_concurrently(upload_job, jobs, max_workers or self.max_workers):
+            if e is None:
+                summary.add_success(fullname, os.path.getsize(fullname))
+            else:
+                summary.add_failure(fullname, e)
+        return summary.report("Uploaded") and not failed
+
+    def upload_jobs(self, localdir, folder_id, created):
+        """
+        Walk local directory, creating the Google Drive folders it needs
+
+        Yield a (local path, folder id, file id) tuple for every file that
+        should be uploaded, where file id is None for new files
+        """
+        # Dict mapping local absolute paths with their Google Drive folder ids
+        folders = {localdir: folder_id}
+
+        for dn, dirs, files in self.walk(localdir):
+            subfolder = dn[len(localdir):].strip(os.path.sep)
+            if subfolder != '':
+                logging.info('Descending into ' + subfolder)
+
+            # List respective Google Drive folder once, new folders are empty
+            folder_id = folders[dn]
+            if folder_id in created:
+                contents = {}
+            else:
+                contents = self.list_folder(folder_id)
+
+            # First do all the files
+            for name in files:
+                yield os.path.join(dn, name), folder_id, contents.get((name, False))
+
+            # Then create folders that don't exist on Google Drive in batches
+            missing = [name for name in dirs if (name, True) not in contents]
+            for name, (subfolder_id, error) in self.create_folders(missing, folder_id).items():
+                if error is not None:
+                    utils.print_string("Could not create folder '{}' on Google Drive: {}".format(
+                        os.path.join(dn, name), error), utils.PrintStyle.ERROR)
+                    dirs.remove(name)
+                    continue
+                created.add(subfolder_id)
+                contents[(name, True)] = subfolder_id
+
+            for name in dirs:
+                logging.info('Keeping directory:' + name)
+                folders[os.path.join(dn, name)] = contents[(name, True)]
+
+    def upload(self, localdir, gd_path, preallocate_ids=False, max_workers=None):
         """
         Upload file or directory to Google Drive
+
+        Up to max_workers files are uploaded concurrently. If preallocate_ids
+        is true, directories are uploaded with upload_preallocated
         """
+        self.reserve(max_workers)
         localdir = os.path.expanduser(localdir)
         localdir = localdir.replace('/', SEPARATOR)
         localdir = localdir.rstrip(SEPARATOR)
@@ -332,12 +810,9 @@ class Gdrive(DataService):
                 localdir), utils.PrintStyle.ERROR)
             return None
 
-        gfolder = None
-
         # Get Google Drive directory to upload to
         gd_path = gd_path.replace('/', SEPARATOR)
-        id, is_folder = self.traverse(gd_path)
-        gfolder = self.client.files().get(fileId=id).execute()
+        gfolder_id, is_folder = self.traverse(gd_path)
 
         logging.info("Local directory: " + localdir)
         logging.info("Google Drive path: " + gd_path)
@@ -346,118 +821,97 @@ class Gdrive(DataService):
         if os.path.isfile(localdir):
             logging.info(localdir + " is a local file")
             key = localdir.split(SEPARATOR)[-1]
-            file_id = self.exists(gfolder.get('id'), key)
+            file_id = self.exists(gfolder_id, key)
             self.upload_file(
-                localdir, folder_id=gfolder.get('id'), file_id=file_id)
+                localdir, folder_id=gfolder_id, file_id=file_id)
+            record_transfer(os.path.getsize(localdir))
 
         # Upload folder content
+        elif os.path.isdir(localdir) and preallocate_ids:
+            logging.info(localdir + " is a local directory, using pre-allocated ids")
+            if not self.upload_preallocated(localdir, gfolder_id, max_workers):
+                return None
+
         elif os.path.isdir(localdir):
             logging.info(localdir + " is a local directory")
             name = localdir.split(SEPARATOR)[-1]
 
             # Create subfolder where contents will be uploaded, if it doesn't already exist
-            folder_id = self.exists(gfolder.get('id'), name, True)
+            folder_id = self.exists(gfolder_id, name, True)
             if folder_id is None:
-                logging.info(
-                    "Creating Google Drive subdirectory '{}'".format(name))
-                try:
-                    metadata = {
-                        'name': name,
-                        'mimeType': 'application/vnd.google-apps.folder',
-                        'parents': [gfolder.get('id')]
-                    }
-                    current_folder = self.client.files().create(
-                        body=metadata, fields='id').execute()
-                except HttpError as e:
-                    utils.print_string("Could not create folder '{}' on Google Drive: {}".format(
-                    name, e), utils.PrintStyle.ERROR)
+                folder_id = self.create_folder(name, gfolder_id)
+                if folder_id is None:
+                    return None
+                created = {folder_id}
             else:
-                current_folder = self.client.files().get(fileId=folder_id).execute()
-
-            # Dict mapping Google Drive folders with their local absolute paths
-            folders = {}
-
-            for dn, dirs, files in os.walk(localdir):
-                subfolder = dn[len(localdir):].strip(os.path.sep)
-                if subfolder != '':
-                    logging.info('Descending into ' + subfolder)
-
-                    # Get respective Google Drive folder
-                    current_folder = self.client.files().get(
-                        fileId=folders[dn], fields='id, name').execute()
-
-                # First do all the files
-                for name in files:
-                    fullname = os.path.join(dn, name)
-                    if name.startswith('.'):
-                        logging.info('Skipping dot file: ' + name)
-                    elif name.startswith('@') or name.endswith('~'):
-                        logging.info('Skipping temporary file: ' + name)
-                    elif name.endswith('.pyc') or name.endswith('.pyo'):
-                        logging.info('Skipping generated file: ' + name)
-                    else:
-                        file_id = self.exists(current_folder.get('id'), name)
-                        self.upload_file(
-                            fullname, folder_id=current_folder.get('id'), file_id=file_id)
-
-                # Then choose which subdirectories to traverse
-                keep = []
-                for name in dirs:
-                    if name.startswith('.'):
-                        logging.info('Skipping dot directory: ' + name)
-                    elif name.startswith('@') or name.endswith('~'):
-                        logging.info('Skipping temporary directory: ' + name)
-                    elif name == '__pycache__':
-                        logging.info('Skipping generated directory:' + name)
-                    else:
-                        logging.info('Keeping directory:' + name)
-                        keep.append(name)
-
-                        folder_id = self.exists(
-                            current_folder.get('id'), name, True)
-
-                        # If folder doesn't exist on Google Drive, create it
-                        if folder_id is None:
-                            logging.info(
-                                "Creating Google Drive subdirectory '{}'".format(name))
-                            try:
-                                metadata = {
-                                    'name': name,
-                                    'mimeType': 'application/vnd.google-apps.folder',
-                                    'parents': [current_folder.get('id')]
-                                }
-                                folder_id = self.client.files().create(
-                                    body=metadata, fields='id').execute().get('id')
-                            except HttpError as e:
-                                utils.print_string("Could not create folder '{}' on Google Drive: {}".format(
-                                    os.path.join(dn, name), e), utils.PrintStyle.ERROR)
-                        folders[os.path.join(dn, name)] = folder_id
-                dirs[:] = keep
+                created = set()
+
+            def upload_job(job):
+                fullname, folder_id, file_id = job
+                return self.upload_file(fullname, folder_id=folder_id, file_id=file_id)
+
+            summary = TransferSummary()
+            jobs = self.upload_jobs(localdir, folder_id, created)
+            for (fullname, folder_id, file_id), id, e in run_concurrently(upload_job, jobs, max_workers or self.max_workers):
+                if e is None:
+                    summary.add_success(fullname, os.path.getsize(fullname))
+                else:
+                    summary.add_failure(fullname, e)
+            if not summary.report("Uploaded"):
+                return None
+
         utils.print_string("All uploads successful", utils.PrintStyle.SUCCESS)
 
-    def delete(self, gd_path):
+    def delete(self, gd_paths):
         """
-        Delete Google Drive file or directory
+        Delete one or more Google Drive files or directories
+
+        Several paths are deleted with batch requests of up to BATCH_SIZE
+        calls each
         """
-        # Get id of Google Drive item that will be deleted
-        id, is_folder = self.traverse(gd_path)
+        if isinstance(gd_paths, str):
+            gd_paths = [gd_paths]
 
-        # Delete specified content
-        try:
-            self.client.files().delete(fileId=id).execute()
+        # Get ids of the Google Drive items that will be deleted
+        paths = {}
+        for gd_path in gd_paths:
+            id, is_folder = self.traverse(gd_path)
+            paths[id] = gd_path
+
+        if len(paths) == 1:
+            id, gd_path = next(iter(paths.items()))
+            try:
+                self.execute(self.client.files().delete(fileId=id))
+            except HttpError as e:
+                utils.print_string("Could not delete '{}': {}".format(
+                    gd_path, e), utils.PrintStyle.ERROR)
+                return None
+            self.forget_path(gd_path)
             utils.print_string("Successfully deleted '{}'".format(
                 gd_path), utils.PrintStyle.SUCCESS)
-        except HttpError as e:
-            utils.print_string("Could not delete '{}': {}".format(
-                gd_path, e), utils.PrintStyle.ERROR)
+            return
+
+        logging.info("Deleting {} paths".format(len(paths)))
+        summary = TransferSummary()
+        for id, error in self.delete_items(paths).items():
+            if error is None:
+                self.forget_path(paths[id])
+                summary.add_success(paths[id])
+            else:
+                summary.add_failure(paths[id], error)
+        if not summary.report("Deleted"):
+            return None
+
+        utils.print_string("Successfully deleted {} items".format(
+            len(paths)), utils.PrintStyle.SUCCESS)
 
     def close(self):
         """
         Close Google Drive handler, cleaning up resources.
         """
-        if isinstance(self.client, Resource):
+        if isinstance(self.clients, ClientPool):
             logging.info("Cleaning up Drive resources")
-            self.client.close()
+            self.clients.close()
         else:
             logging.warning("Error when cleaning up Drive resources.")
 
@@ -466,9 +920,141 @@ class Gdrive(DataService):
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
 
-def authenticate_OAuth2():
+def escape_query(value):
     """
-    Authenticate using traditional 3-legged OAuth2
+    Escape a string literal for use in a Drive API search query
+    """
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class SharedCredentials:
+    """
+    OAuth2 credentials shared by the clients of every thread
+
+    Refreshes are serialized, so an expired token is refreshed once and the
+    new token is then used by all threads
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.credentials, name)
+
+    def before_request(self, request, method, url, headers):
+        if not self.credentials.valid:
+            self.refresh(request)
+        self.local.token = self.credentials.token
+        self.credentials.apply(headers)
+
+    def refresh(self, request):
+        with self.lock:
+            # Another thread refreshed the token since this thread last used it
+            if self.credentials.valid and self.credentials.token != getattr(self.local, 'token', None):
+                return
+            logging.info("Refreshing Drive access token")
+            self.credentials.refresh(request)
+            save_credentials(self.credentials)
+
+
+class ClientPool:
+    """
+    A single Drive client that builds requests, and a bounded pool of
+    connections they are executed on, all sharing the same credentials
+
+    Connections are backed by httplib2, which is not thread-safe, so each is
+    checked out by one thread at a time. At most size connections are ever
+    opened, however many threads the transfers start
+    """
+
+    def __init__(self, credentials, size=MAX_WORKERS):
+        self.credentials = SharedCredentials(credentials)
+        self.size = size
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.connections = []
+
+        # Requests are only built with this client, never executed on its own
+        # connection
+        self.client = build('drive', 'v3', http=self.connect())
+
+    def grow(self, size):
+        """
+        Allow up to size connections to be opened
+        """
+        with self.lock:
+            self.size = max(self.size, size)
+
+    def connect(self):
+        return google_auth_httplib2.AuthorizedHttp(
+            self.credentials, http=httplib2.Http())
+
+    @contextlib.contextmanager
+    def http(self):
+        """
+        Check out a connection for the duration of the with block, opening
+        one if fewer than size exist, otherwise waiting for one to be
+        checked back in
+        """
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                http = None
+                if len(self.connections) < self.size:
+                    http = self.connect()
+                    self.connections.append(http)
+            if http is None:
+                http = self.idle.get()
+        try:
+            yield http
+        finally:
+            self.idle.put(http)
+
+    def close(self):
+        with self.lock:
+            for http in self.connections:
+                http.close()
+            self.connections = []
+            self.client.close()
+
+
+def classify_error(e):
+    """
+    Decide whether a failed Drive API call should be retried
+
+    Returns None if it shouldn't, otherwise a (throttled, retry_after) pair
+    for RateController
+    """
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        retry_after = parse_retry_after(e.resp.get('retry-after'))
+        reasons = [detail.get('reason') for detail in (e.error_details or [])
+                   if isinstance(detail, dict)]
+        if status == 429 or any(reason in RATE_LIMIT_REASONS for reason in reasons):
+            return True, retry_after
+        if status in (500, 502, 503, 504):
+            return status == 503, retry_after
+        return None
+    if isinstance(e, (httplib2.HttpLib2Error, ConnectionError, TimeoutError)):
+        return False, None
+    return None
+
+
+def save_credentials(creds):
+    """
+    Save the credentials for the next run
+    """
+    with open('../data/drive_token.json', 'w') as token:
+        token.write(creds.to_json())
+
+
+def get_credentials():
+    """
+    Load stored OAuth2 credentials, refreshing them or running the
+    3-legged OAuth2 flow if needed
     """
     creds = None
 
@@ -486,14 +1072,18 @@ def authenticate_OAuth2():
             flow = InstalledAppFlow.from_client_secrets_file(
                 '../data/drive_credentials.json', SCOPES)
             creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('../data/drive_token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_credentials(creds)
 
     logging.info("Client ID: " + creds.client_id)
     logging.info("Client secret: " + creds.client_secret)
     logging.info("Refresh token: " + creds.refresh_token)
+    return creds
 
-    # Create and return client
-    client = build('drive', 'v3', credentials=creds)
-    return client
+
+def authenticate_OAuth2(max_connections=MAX_WORKERS):
+    """
+    Authenticate using traditional 3-legged OAuth2
+
+    Return a pool of at most max_connections Drive connections
+    """
+    return ClientPool(get_credentials(), max_connections)
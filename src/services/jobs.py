@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+import time
+import utils
+from services.data_service import DataService
+from services.scheduler import Scheduler
+from services.transfer import JobStats, job_stats
+
+# Default number of batch operations run at once
+BATCH_WORKERS = 4
+
+# Keys every manifest operation needs, by action
+REQUIRED_KEYS = {
+    'upload': ('service', 'action', 'local_path', 'remote_path'),
+    'download': ('service', 'action', 'local_path', 'remote_path'),
+    'delete': ('service', 'action', 'remote_path'),
+    'copy': ('service', 'action', 'remote_path', 'dest_path'),
+    'move': ('service', 'action', 'remote_path', 'dest_path'),
+}
+
+
+class ServiceCache:
+    """
+    Keeps one authenticated DataService per provider, so that jobs reuse
+    warm clients instead of importing and authenticating every time
+    """
+
+    def __init__(self):
+        self.services = {}
+        self.lock = threading.Lock()
+
+        # Number of jobs currently using each service
+        self.active = {}
+
+    def get(self, service_name):
+        """
+        Return the service with the given name, building it on first use
+        """
+        with self.lock:
+            service = self.services.get(service_name)
+            if service is None:
+                logging.info("Starting service '{}'".format(service_name))
+                service = DataService.build(service_name)
+                self.services[service_name] = service
+            return service
+
+    @contextlib.contextmanager
+    def use(self, service_name):
+        """
+        Hold the service with the given name for the duration of a job
+
+        Its caches are reset when a job starts while no other job is using
+        it, so jobs don't see state cached before they started, and jobs
+        that are still running keep theirs
+        """
+        service = self.get(service_name)
+        with self.lock:
+            if not self.active.get(service_name):
+                service.reset_caches()
+            self.active[service_name] = self.active.get(service_name, 0) + 1
+        try:
+            yield service
+        finally:
+            with self.lock:
+                self.active[service_name] -= 1
+
+    def close(self):
+        with self.lock:
+            for service in self.services.values():
+                service.close()
+            self.services.clear()
+
+
+class JobOutput:
+    """
+    Receives the output of a job through utils.output_sink, recording
+    whether the job reported an error
+
+    Subclasses decide where the output goes
+    """
+
+    def __init__(self):
+        self.failed = False
+
+    def write(self, message, style):
+        if style == utils.PrintStyle.ERROR:
+            self.failed = True
+        self.emit(message, style)
+
+    def emit(self, message, style):
+        utils.print_styled(message, style)
+
+    def log(self, message):
+        pass
+
+
+class SinkLogHandler(logging.Handler):
+    """
+    Forwards log records to the output sink of the job that emitted them
+    """
+
+    def emit(self, record):
+        sink = utils.output_sink.get()
+        if sink is not None:
+            sink.log(self.format(record))
+
+
+def run_job(cache, job, output):
+    """
+    Run a job on its cached service, sending everything it prints to output
+
+    job is a dict of the arguments main.py would parse for the same
+    command. Backends report most failures by printing an error, and some
+    exit the process, so both count as a failed job
+
+    Returns true if the job succeeded, otherwise returns false
+    """
+    token = utils.output_sink.set(output)
+    try:
+        with cache.use(job['service']) as service:
+            service.execute_action(argparse.Namespace(**job))
+        return not output.failed
+    except SystemExit:
+        return False
+    except Exception as e:
+        output.write("Job failed: {}".format(e), utils.PrintStyle.ERROR)
+        return False
+    finally:
+        utils.output_sink.reset(token)
+
+
+def timed_job(cache, job, output):
+    """
+    Run a job, returning whether it succeeded and how many seconds it took
+    """
+    start = time.time()
+    ok = run_job(cache, job, output)
+    return ok, time.time() - start
+
+
+class BatchOutput(JobOutput):
+    """
+    Prints the output of a batch operation, prefixed with its manifest line
+    """
+
+    def __init__(self, number):
+        super().__init__()
+        self.number = number
+
+    def emit(self, message, style):
+        utils.print_styled("[{}] {}".format(self.number, message), style)
+
+
+def read_manifest(manifest_path):
+    """
+    Yield a (line number, job, error) tuple for every operation of a
+    JSON-lines manifest, reading it lazily
+
+    Every line holds an object with the arguments main.py would parse for
+    the same command. job is None for lines that aren't valid operations
+    """
+    with open(manifest_path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                yield number, None, "Invalid JSON: {}".format(e)
+                continue
+            if not isinstance(job, dict) or job.get('action') not in REQUIRED_KEYS:
+                yield number, None, "Unknown action"
+                continue
+            missing = [key for key in REQUIRED_KEYS[job['action']] if key not in job]
+            if missing:
+                yield number, None, "Missing {}".format(', '.join(missing))
+                continue
+            yield number, job, None
+
+
+def run_operation(cache, number, job):
+    """
+    Run a single batch operation and return its result record
+
+    Every transfer of the operation, single files included, is counted in
+    the JobStats of its context, so concurrent operations never see each
+    other's files
+    """
+    stats = JobStats()
+    token = job_stats.set(stats)
+    started = time.time()
+    try:
+        ok = run_job(cache, job, BatchOutput(number))
+    finally:
+        job_stats.reset(token)
+    elapsed = time.time() - started
+
+    return {
+        'ok': ok, 'started': started, 'elapsed': round(elapsed, 3),
+        'items': stats.items, 'bytes': stats.bytes
+    }
+
+
+def run_batch(manifest_path, results_path, max_workers=BATCH_WORKERS, provider_limits=None):
+    """
+    Run every operation of a JSON-lines manifest in this process
+
+    Services are built once and shared by all operations. Operations are
+    run by a Scheduler, with at most max_workers at once overall and at most
+    provider_limits[name] at once for the given providers. A JSON line with
+    the timing and byte count of every operation is appended to results_path
+    as soon as it finishes
+
+    Returns true if all operations succeeded, otherwise returns false
+    """
+    return asyncio.run(run_batch_async(
+        manifest_path, results_path, max_workers, provider_limits))
+
+
+async def run_batch_async(manifest_path, results_path, max_workers=BATCH_WORKERS, provider_limits=None):
+    """
+    Coroutine behind run_batch, for callers that already run an event loop
+    """
+    scheduler = Scheduler(max_workers, provider_limits)
+    cache = ServiceCache()
+
+    def run(entry):
+        number, job, error = entry
+        if error is not None:
+            return {'ok': False, 'error': error}
+        return run_operation(cache, number, job)
+
+    def provider(entry):
+        number, job, error = entry
+        return job['service'] if job is not None else None
+
+    total = 0
+    failed = 0
+    start = time.time()
+    try:
+        with open(results_path, 'w') as results:
+            async for (number, job, error), result, e in scheduler.map(
+                    run, read_manifest(manifest_path), provider):
+                if e is not None:
+                    result = {'ok': False, 'error': str(e)}
+                record = {'line': number}
+                if job is not None:
+                    record.update({key: job.get(key) for key in
+                                   ('service', 'action', 'local_path', 'remote_path')})
+                record.update(result)
+                results.write(json.dumps(record) + '\n')
+                results.flush()
+
+                total += 1
+                if not record['ok']:
+                    failed += 1
+                    utils.print_string("[{}] Operation failed{}".format(
+                        number, ": " + record['error'] if 'error' in record else ''),
+                        utils.PrintStyle.ERROR)
+    finally:
+        scheduler.close()
+        cache.close()
+
+    logging.info("Ran {} operations in {:.2f} seconds".format(total, time.time() - start))
+    if failed:
+        utils.print_string("{} of {} operations failed, see '{}'".format(
+            failed, total, results_path), utils.PrintStyle.ERROR)
+        return False
+    utils.print_string("All {} operations successful, results in '{}'".format(
+        total, results_path), utils.PrintStyle.SUCCESS)
+    return True
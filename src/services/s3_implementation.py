@@ -2,11 +2,15 @@ import utils
 import logging
 import os
 import sys
+import threading
 import boto3
 from boto3.s3.transfer import TransferConfig
 import botocore.exceptions
 import botocore.client
+from botocore.config import Config
+from services.backoff import RateController
 from services.data_service import DataService
+from services.transfer import MAX_WORKERS, RANGED_THRESHOLD, RANGE_SIZE, TransferSummary, chain_ahead, chunked, record_transfer, run_concurrently
 
 # hack to allow importing modules from parent directory
 sys.path.insert(0, os.path.abspath('..'))
@@ -16,10 +20,125 @@ CHUNK_SIZE = 32 * MB
 THRESHOLD = 32 * MB
 SEPARATOR = os.path.sep
 
+# Maximum number of keys accepted by a single delete_objects call
+DELETE_BATCH_SIZE = 1000
+
+# Listings are split into shards at common prefixes at most this many
+# levels deep, and only until there is a shard for every worker
+SHARD_DEPTH = 3
+
+# Prefixes with more delimited listing pages than this aren't split further
+# and are listed as a single shard
+DISCOVERY_PAGES = 10
+
+# Number of listing pages fetched ahead of the consumer for every shard
+SHARD_PAGES_AHEAD = 4
+
+# Maximum number of shards listed for every worker. Every shard costs at
+# least one listing call, so runs of small prefixes are merged into key
+# ranges beyond this
+SHARDS_PER_WORKER = 2
+
+# Region of buckets whose location can't be determined otherwise
+DEFAULT_REGION = 'us-east-1'
+
+# Error codes S3 uses to signal that requests are being throttled
+THROTTLING_CODES = {'SlowDown', 'Throttling', 'ThrottlingException',
+                    'RequestLimitExceeded', 'TooManyRequestsException'}
+
 
 class S3(DataService):
-    def __init__(self):
-        self.client = authenticate()
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.session = authenticate()
+        self.max_workers = max_workers
+        self.rate = RateController('S3', classify_error, max_workers)
+
+        # Dicts mapping bucket names to their regions, and regions to the
+        # clients of single requests and of file transfers
+        self.bucket_regions = {}
+        self.clients = {}
+        self.transfer_clients = {}
+        self.lock = threading.Lock()
+
+        # Client of the profile's region, for requests that aren't bucket specific
+        self.client = self.regional_client(
+            self.session.region_name or DEFAULT_REGION)
+
+    def regional_client(self, region, transfer=False):
+        """
+        Return the client for the given region, creating it on first use
+
+        Single requests are retried by self.rate, which must see throttling
+        and server errors to adapt, so botocore doesn't retry them. File
+        transfers use separate clients that keep botocore's retries, so that
+        a throttled part is retried on its own instead of failing the whole
+        file. Every concurrent transfer may itself use up to max_workers
+        connections for its parts, so the connection pool is sized for that
+        """
+        clients = self.transfer_clients if transfer else self.clients
+        with self.lock:
+            client = clients.get(region)
+            if client is None:
+                logging.info("Creating S3 {}client for region '{}'".format(
+                    'transfer ' if transfer else '', region))
+                retries = {'mode': 'standard'}
+                if not transfer:
+                    retries['total_max_attempts'] = 1
+                config = Config(
+                    region_name=region,
+                    max_pool_connections=self.max_workers * self.max_workers,
+                    retries=retries)
+                client = self.session.client('s3', config=config)
+                clients[region] = client
+            return client
+
+    def bucket_region(self, bucket_name):
+        """
+        Return the region of an S3 bucket, looking it up once per bucket
+
+        The region is read from the header of a head_bucket response, which
+        S3 also sets on redirects and access errors. get_bucket_location is
+        used as a fallback
+        """
+        with self.lock:
+            region = self.bucket_regions.get(bucket_name)
+        if region is not None:
+            return region
+
+        try:
+            response = self.rate.call(self.client.head_bucket, Bucket=bucket_name)
+        except botocore.exceptions.ClientError as e:
+            response = e.response
+        region = response.get('ResponseMetadata', {}).get(
+            'HTTPHeaders', {}).get('x-amz-bucket-region')
+
+        if region is None:
+            try:
+                location = self.rate.call(
+                    self.client.get_bucket_location, Bucket=bucket_name).get('LocationConstraint')
+                # Buckets in us-east-1 have no location constraint
+                region = {None: DEFAULT_REGION, 'EU': 'eu-west-1'}.get(location, location)
+            except botocore.exceptions.ClientError as e:
+                logging.info("Could not find region of bucket '{}': {}".format(
+                    bucket_name, e))
+                return self.client.meta.region_name
+
+        logging.info("Bucket '{}' is in region '{}'".format(bucket_name, region))
+        with self.lock:
+            self.bucket_regions[bucket_name] = region
+        return region
+
+    def client_for(self, bucket_name):
+        """
+        Return the client for the region of the given bucket
+        """
+        return self.regional_client(self.bucket_region(bucket_name))
+
+    def transfer_client_for(self, bucket_name):
+        """
+        Return the client for file transfers in the region of the given bucket
+        """
+        return self.regional_client(self.bucket_region(bucket_name), transfer=True)
 
     def create_bucket(self, bucket_name, region=None):
         """
@@ -32,69 +151,222 @@ class S3(DataService):
         """
         try:
             if region is None:
-                self.client.create_bucket(Bucket=bucket_name)
+                self.rate.call(self.regional_client(DEFAULT_REGION).create_bucket, Bucket=bucket_name)
             else:
                 location = {'LocationConstraint': region}
-                self.client.create_bucket(
-                    Bucket=bucket_name, CreateBucketConfiguration=location)
+                self.rate.call(self.regional_client(region).create_bucket,
+                               Bucket=bucket_name, CreateBucketConfiguration=location)
         except botocore.exceptions.ClientError as e:
             utils.print_string("Could not create bucket '{}': {}".format(
                 bucket_name, e), utils.PrintStyle.ERROR)
             return False
         return True
 
+    def download_config(self):
+        """
+        Configuration for ranged downloads
+
+        Objects above RANGED_THRESHOLD are fetched as concurrent ranged GETs
+        written at their offsets in the local file, like the shared
+        transfer.ranged_download engine used by the other services
+        """
+        return TransferConfig(
+            multipart_threshold=RANGED_THRESHOLD, multipart_chunksize=RANGE_SIZE,
+            max_concurrency=self.max_workers)
+
+    def list_pages(self, bucket_name, prefix=None, start=None, end=None):
+        """
+        Yield the objects of an S3 bucket one page at a time
+
+        Each list_objects_v2 call returns at most 1000 keys, so follow
+        continuation tokens until the listing is exhausted. If given, only
+        keys that are at least start and less than end are listed
+        """
+        kwargs = {'Bucket': bucket_name}
+        if prefix is not None:
+            kwargs['Prefix'] = prefix
+        if start:
+            # StartAfter skips its own key, so start listing just before
+            # start and drop the few keys listed before it
+            kwargs['StartAfter'] = start[:-1]
+        while True:
+            result = self.rate.call(self.client_for(bucket_name).list_objects_v2, **kwargs)
+            objects = result.get('Contents', [])
+            if start:
+                objects = [object for object in objects if object['Key'] >= start]
+            if end is not None and objects and objects[-1]['Key'] >= end:
+                yield [object for object in objects if object['Key'] < end]
+                break
+            yield objects
+            if not result.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = result['NextContinuationToken']
+
+    def discover(self, bucket_name, prefix):
+        """
+        List the keys directly below prefix and the common prefixes below
+        it, using a delimited listing
+
+        Return a key-ordered list of ('object', object) and ('shard', prefix)
+        entries, or None if the prefix holds too many entries to be split
+        """
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix, 'Delimiter': '/'}
+        entries = []
+        for page in range(DISCOVERY_PAGES):
+            result = self.rate.call(self.client_for(bucket_name).list_objects_v2, **kwargs)
+            entries.extend(('object', object) for object in result.get('Contents', []))
+            entries.extend(('shard', common['Prefix']) for common in result.get('CommonPrefixes', []))
+            if not result.get('IsTruncated'):
+                entries.sort(key=entry_key)
+                return entries
+            kwargs['ContinuationToken'] = result['NextContinuationToken']
+        return None
+
+    def plan_shards(self, bucket_name, prefix=None):
+        """
+        Split the listing of the keys below prefix at common prefixes
+
+        Prefixes are discovered level by level, in parallel, until there are
+        enough shards for every worker. If there are more than
+        SHARDS_PER_WORKER shards for every worker, runs of entries are
+        merged into ('range', start) entries, covering the keys from start
+        up to the next entry
+
+        Return a key-ordered list of ('object', object), ('shard', prefix)
+        and ('range', start) entries that together cover every key below
+        prefix
+        """
+        entries = [('shard', prefix or '')]
+        leaves = set()
+        for level in range(SHARD_DEPTH):
+            shards = [value for kind, value in entries if kind == 'shard']
+            if len(shards) >= self.max_workers:
+                break
+            shards = [shard for shard in shards if shard not in leaves]
+            if not shards:
+                break
+
+            logging.info("Discovering prefixes of {} shards".format(len(shards)))
+            expanded = {}
+            for shard, result, e in run_concurrently(
+                    lambda shard: self.discover(bucket_name, shard), shards, self.max_workers):
+                if e is not None:
+                    raise e
+                if result is None:
+                    leaves.add(shard)
+                else:
+                    expanded[shard] = result
+
+            split = []
+            for kind, value in entries:
+                if kind == 'shard' and value in expanded:
+                    split.extend(expanded[value])
+                else:
+                    split.append((kind, value))
+            entries = split
+
+        target = self.max_workers * SHARDS_PER_WORKER
+        if sum(kind == 'shard' for kind, value in entries) <= target:
+            return entries
+
+        # Split the entries into target runs of about the same length
+        size = -(-len(entries) // target)
+        merged = []
+        for start in range(0, len(entries), size):
+            run = entries[start:start + size]
+            if len(run) == 1 or all(kind == 'object' for kind, value in run):
+                merged.extend(run)
+            else:
+                merged.append(('range', entry_key(run[0])))
+        logging.info("Merged {} entries into {} shards".format(len(entries), len(merged)))
+        return merged
+
+    def list_objects(self, bucket_name, prefix=None):
+        """
+        Yield every object of an S3 bucket in key order, optionally
+        restricted to a prefix
+
+        The keys are split into shards at common prefixes, and the next
+        shards are listed in parallel while the current one is consumed.
+        Every shard only holds a few pages in memory at once
+        """
+        def segments():
+            entries = self.plan_shards(bucket_name, prefix)
+            objects = []
+            for i, (kind, value) in enumerate(entries):
+                if kind == 'object':
+                    objects.append(value)
+                    continue
+                if objects:
+                    yield [objects]
+                    objects = []
+                if kind == 'shard':
+                    yield self.list_pages(bucket_name, value)
+                else:
+                    end = entry_key(entries[i + 1]) if i + 1 < len(entries) else None
+                    yield self.list_pages(bucket_name, prefix, value, end)
+            if objects:
+                yield [objects]
+
+        for page in chain_ahead(segments(), self.max_workers, SHARD_PAGES_AHEAD):
+            yield from page
+
     def download_directory(self, localdir, bucket_name, folder_name=None):
         """
         Download a directory from S3
 
         If no directory is specified, download the bucket itself
         """
-        try:
-            result = {}
+        def download_object(object):
+            if folder_name is None:
+                substring = object['Key'].replace('/', SEPARATOR)
+            else:
+                substring = object['Key'].split(folder_name, 1)[
+                    1].replace('/', SEPARATOR)
 
+            # Object is a file, download it
+            if not object['Key'].endswith('/'):
+
+                # If folder that contains file doesn't exist locally, create it
+                first, delim, last = substring.rpartition(SEPARATOR)
+                if first and delim:
+                    dir = os.path.join(localdir, first)
+                    if not os.path.exists(dir):
+                        logging.info("Creating directory '{}'".format(dir))
+                        os.makedirs(dir, exist_ok=True)
+                    path = os.path.join(dir, last)
+                else:
+                    path = os.path.join(localdir, last)
+
+                logging.info("Downloading file '{}'".format(object['Key']))
+                self.transfer_client_for(bucket_name).download_file(
+                    bucket_name, object['Key'], path, Config=self.download_config())
+                return object['Size']
+
+            # Object is a folder, create it locally if it doesn't exist
+            else:
+                dir = os.path.join(localdir, substring)
+                if not os.path.exists(dir):
+                    logging.info(
+                        "Creating local directory {}''".format(dir))
+                    os.makedirs(dir, exist_ok=True)
+                return 0
+
+        try:
             # Get objects to download
             if folder_name is not None:
                 logging.info("Downloading directory '{}'".format(folder_name))
-                result = self.client.list_objects_v2(
-                    Bucket=bucket_name, Prefix=folder_name)
             else:
                 logging.info("Downloading bucket {}".format(bucket_name))
-                result = self.client.list_objects_v2(Bucket=bucket_name)
+            objects = self.list_objects(bucket_name, folder_name)
 
-            for object in result['Contents']:
-                if folder_name is None:
-                    substring = object['Key'].replace('/', SEPARATOR)
+            summary = TransferSummary()
+            for object, size, e in run_concurrently(download_object, objects, self.max_workers):
+                if e is None:
+                    summary.add_success(object['Key'], size)
                 else:
-                    substring = object['Key'].split(folder_name, 1)[
-                        1].replace('/', SEPARATOR)
-
-                # Object is a file, download it
-                if not object['Key'].endswith('/'):
-
-                    # If folder that contains file doesn't exist locally, create it
-                    first, delim, last = substring.rpartition(SEPARATOR)
-                    if first and delim:
-                        dir = os.path.join(localdir, first)
-                        if not os.path.exists(dir):
-                            logging.info("Creating directory '{}'".format(dir))
-                            os.makedirs(dir)
-                        path = os.path.join(dir, last)
-                    else:
-                        path = os.path.join(localdir, last)
-                    
-                    logging.info("path: " + path)
-
-                    logging.info("Downloading file '{}'".format(object['Key']))
-                    self.client.download_file(bucket_name, object['Key'], path)
-
-                # Object is a folder, create it locally if it doesn't exist
-                else:
-                    dir = os.path.join(localdir, substring)
-                    if not os.path.exists(dir):
-                        logging.info(
-                            "Creating local directory {}''".format(dir))
-                        os.makedirs(dir)
-            return True
+                    summary.add_failure(object['Key'], e)
+            return summary.report("Downloaded")
 
         except botocore.exceptions.ClientError as e:
             if folder_name is None:
@@ -146,7 +418,9 @@ class S3(DataService):
                     "Downloading single object '{}'".format(object_name))
                 try:
                     path = os.path.join(localdir, object_name.split('/')[-1])
-                    self.client.download_file(bucket_name, object_name, path)
+                    self.transfer_client_for(bucket_name).download_file(
+                        bucket_name, object_name, path, Config=self.download_config())
+                    record_transfer(os.path.getsize(path))
                     success = True
                 except botocore.exceptions.ClientError as e:
                     utils.print_string("Could not download object '{}' from bucket '{}': {}".format(
@@ -202,7 +476,7 @@ class S3(DataService):
         # Check if bucket exists
         try:
             logging.info("Checking if bucket '{}' exists".format(bucket_name))
-            self.client.head_bucket(Bucket=bucket_name)
+            self.rate.call(self.client_for(bucket_name).head_bucket, Bucket=bucket_name)
         except botocore.exceptions.ClientError as e:
             if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
                 utils.print_string("Warning: bucket '{}' doesn't exist".format(
@@ -225,68 +499,86 @@ class S3(DataService):
             file_name = localdir.split(SEPARATOR)[-1]
             try:
                 logging.info('Uploading ' + localdir)
-                self.client.upload_file(
+                self.transfer_client_for(bucket_name).upload_file(
                     localdir, bucket_name, object_name + file_name, Config=config)
-            except botocore.exceptions.ClientError as e:
+            except (botocore.exceptions.ClientError, boto3.exceptions.S3UploadFailedError) as e:
                 utils.print_string("Could not upload file '{}': {}".format(
                     localdir, e), utils.PrintStyle.ERROR)
                 return None
+            record_transfer(os.path.getsize(localdir))
 
         # Upload folder
         elif os.path.isdir(localdir):
             logging.info(localdir + ' is a local folder')
 
-            for dn, dirs, files in os.walk(localdir):
-                subfolder = dn[len(localdir):].strip(os.path.sep)
-                if subfolder != '':
-                    logging.info('Descending into ' + subfolder)
-
-                # First do all the files
-                for name in files:
-                    fullname = os.path.join(dn, name)
-                    if name.startswith('.'):
-                        logging.info('Skipping dot file: ' + name)
-                    elif name.startswith('@') or name.endswith('~'):
-                        logging.info('Skipping temporary file: ' + name)
-                    elif name.endswith('.pyc') or name.endswith('.pyo'):
-                        logging.info('Skipping generated file: ' + name)
-                    else:
-                        try:
-                            # Define object key in such a way that S3
-                            # will automatically create required folders
-                            key = localdir.split(SEPARATOR)[-1]
-                            if not object_name == '':
-                                key = os.path.join(key,
-                                    object_name, subfolder, name)
-                            else:
-                                key = os.path.join(key,subfolder, name)
-                            key = key.replace(SEPARATOR, '/')
-                            logging.info('Uploading ' + fullname)
-                            self.client.upload_file(
-                                fullname, bucket_name, key, Config=config)
-                            utils.print_string("File '{}' uploaded successfully".format(
-                                fullname), utils.PrintStyle.SUCCESS)
-                        except botocore.exceptions.ClientError as e:
-                            utils.print_string("Could not upload file '{}': {}".format(
-                                fullname, e), utils.PrintStyle.ERROR)
-                            return None
-
-                # Then choose which subdirectories to traverse
-                keep = []
-                for name in dirs:
-                    if name.startswith('.'):
-                        logging.info('Skipping dot directory: ' + name)
-                    elif name.startswith('@') or name.endswith('~'):
-                        logging.info('Skipping temporary directory: ' + name)
-                    elif name == '__pycache__':
-                        logging.info('Skipping generated directory:' + name)
-                    else:
-                        logging.info('Keeping directory:' + name)
-                        keep.append(name)
-                dirs[:] = keep
+            # boto3 clients are thread-safe, so all workers share the bucket's client
+            def upload_object(job):
+                fullname, key = job
+                logging.info('Uploading ' + fullname)
+                self.transfer_client_for(bucket_name).upload_file(
+                    fullname, bucket_name, key, Config=config)
+                return os.path.getsize(fullname)
+
+            summary = TransferSummary()
+            jobs = self.upload_jobs(localdir, object_name)
+            for (fullname, key), size, e in run_concurrently(upload_object, jobs, self.max_workers):
+                if e is None:
+                    summary.add_success(fullname, size)
+                    utils.print_string("File '{}' uploaded successfully".format(
+                        fullname), utils.PrintStyle.SUCCESS)
+                else:
+                    summary.add_failure(fullname, e)
+
+            if not summary.report("Uploaded"):
+                return None
 
         utils.print_string("All uploads successful", utils.PrintStyle.SUCCESS)
 
+    def upload_jobs(self, localdir, object_name):
+        """
+        Walk local directory and yield a (local path, object key) pair for
+        every file that should be uploaded
+        """
+        for dn, dirs, files in os.walk(localdir):
+            subfolder = dn[len(localdir):].strip(os.path.sep)
+            if subfolder != '':
+                logging.info('Descending into ' + subfolder)
+
+            # First do all the files
+            for name in files:
+                fullname = os.path.join(dn, name)
+                if name.startswith('.'):
+                    logging.info('Skipping dot file: ' + name)
+                elif name.startswith('@') or name.endswith('~'):
+                    logging.info('Skipping temporary file: ' + name)
+                elif name.endswith('.pyc') or name.endswith('.pyo'):
+                    logging.info('Skipping generated file: ' + name)
+                else:
+                    # Define object key in such a way that S3
+                    # will automatically create required folders
+                    key = localdir.split(SEPARATOR)[-1]
+                    if not object_name == '':
+                        key = os.path.join(key,
+                            object_name, subfolder, name)
+                    else:
+                        key = os.path.join(key,subfolder, name)
+                    key = key.replace(SEPARATOR, '/')
+                    yield fullname, key
+
+            # Then choose which subdirectories to traverse
+            keep = []
+            for name in dirs:
+                if name.startswith('.'):
+                    logging.info('Skipping dot directory: ' + name)
+                elif name.startswith('@') or name.endswith('~'):
+                    logging.info('Skipping temporary directory: ' + name)
+                elif name == '__pycache__':
+                    logging.info('Skipping generated directory:' + name)
+                else:
+                    logging.info('Keeping directory:' + name)
+                    keep.append(name)
+            dirs[:] = keep
+
     def empty_bucket(self, bucket_name):
         """
         Empty S3 bucket contents
@@ -295,26 +587,65 @@ class S3(DataService):
         """
         utils.print_string("Emptying bucket '{}'.".format(bucket_name))
         try:
-            result = self.client.list_objects_v2(Bucket=bucket_name)
-            if result['KeyCount'] == 0:
-                logging.warning("Bucket '{}' is already empty".format(
-                    bucket_name))
-                return True
-
-            for object in result['Contents']:
-                logging.info("Deleting object '{}'".format(object['Key']))
-                self.client.delete_object(
-                    Bucket=bucket_name, Key=object['Key'])
-                utils.print_string("Object '{}' deleted successfully".format(
-                    object['Key']), utils.PrintStyle.SUCCESS)
+            summary = self.delete_objects(
+                bucket_name, self.list_objects(bucket_name))
         except botocore.exceptions.ClientError as e:
             utils.print_string("Could not empty bucket '{}': {}".format(
                 bucket_name, e), utils.PrintStyle.ERROR)
             return False
+
+        if summary.count == 0 and not summary.failures:
+            logging.warning("Bucket '{}' is already empty".format(
+                bucket_name))
+            return True
+        if not summary.report("Deleted"):
+            utils.print_string("Could not empty bucket '{}'".format(
+                bucket_name), utils.PrintStyle.ERROR)
+            return False
+
         utils.print_string("Bucket '{}' emptied successfully".format(
             bucket_name), utils.PrintStyle.SUCCESS)
         return True
 
+    def delete_objects(self, bucket_name, objects):
+        """
+        Delete the given objects using batched delete_objects calls
+
+        Keys are grouped into batches of up to 1000, and several batches are
+        kept in flight at once. Per-key errors are collected in the returned
+        TransferSummary instead of aborting the deletion
+        """
+        def delete_batch(batch):
+            logging.info("Deleting {} objects, starting from '{}'".format(
+                len(batch), batch[0]['Key']))
+            return self.rate.call(
+                self.client_for(bucket_name).delete_objects,
+                Bucket=bucket_name,
+                Delete={
+                    'Objects': [{'Key': object['Key']} for object in batch],
+                    'Quiet': True
+                })
+
+        summary = TransferSummary()
+        batches = chunked(objects, DELETE_BATCH_SIZE)
+        for batch, response, e in run_concurrently(delete_batch, batches, self.max_workers):
+            if e is not None:
+                for object in batch:
+                    summary.add_failure(object['Key'], e)
+                continue
+
+            # In quiet mode, the response only lists keys that failed
+            errors = {}
+            for error in response.get('Errors', []):
+                errors[error['Key']] = "{}: {}".format(
+                    error.get('Code'), error.get('Message'))
+            for object in batch:
+                if object['Key'] in errors:
+                    summary.add_failure(object['Key'], errors[object['Key']])
+                else:
+                    summary.add_success(object['Key'], object.get('Size', 0))
+        return summary
+
     def delete(self, s3_path):
         """
         Delete S3 object
@@ -341,36 +672,31 @@ class S3(DataService):
             # Delete folder contents
             if object_name.endswith('/'):
                 logging.info("Deleting folder '{}'".format(object_name))
-                result = self.client.list_objects_v2(
-                    Bucket=bucket_name, Prefix=object_name)
 
-                if result['KeyCount'] == 0:
+                try:
+                    summary = self.delete_objects(
+                        bucket_name, self.list_objects(bucket_name, object_name))
+                except botocore.exceptions.ClientError as e:
+                    utils.print_string("Could not delete folder '{}': {}".format(
+                        object_name, e), utils.PrintStyle.ERROR)
+                    return None
+
+                if summary.count == 0 and not summary.failures:
                     utils.print_string("Error: Folder '{}' doesn't exist".format(
                         object_name), utils.PrintStyle.ERROR)
                     return None
-
-                for object in result['Contents']:
-                    try:
-                        logging.info(
-                            "Deleting object '{}'".format(object['Key']))
-                        self.client.delete_object(
-                            Bucket=bucket_name, Key=object['Key'])
-                        utils.print_string("Object '{}' successfully deleted".format(
-                            object['Key']), utils.PrintStyle.SUCCESS)
-                    except botocore.exceptions.ClientError as e:
-                        utils.print_string("Could not delete object '{}': {}".format(
-                            object['Key'], e), utils.PrintStyle.ERROR)
-                        return None
+                if not summary.report("Deleted"):
+                    return None
 
             # Delete file
             else:
                 try:
                     # Ensure object exists
-                    self.client.head_object(
-                        Bucket=bucket_name, Key=object_name)
+                    self.rate.call(self.client_for(bucket_name).head_object,
+                                   Bucket=bucket_name, Key=object_name)
                     logging.info("Deleting object '{}'".format(object_name))
-                    self.client.delete_object(
-                        Bucket=bucket_name, Key=object_name)
+                    self.rate.call(self.client_for(bucket_name).delete_object,
+                                   Bucket=bucket_name, Key=object_name)
                 except botocore.exceptions.ClientError as e:
                     utils.print_string("Could not delete object '{}': {}".format(
                         object_name, e), utils.PrintStyle.ERROR)
@@ -378,15 +704,17 @@ class S3(DataService):
         # Delete bucket
         else:
             try:
-                result = self.client.list_objects_v2(Bucket=bucket_name)
+                result = self.rate.call(self.client_for(bucket_name).list_objects_v2,
+                                        Bucket=bucket_name, MaxKeys=1)
 
                 # Nonempty bucket
                 if result['KeyCount'] != 0:
                     utils.print_string("Bucket '{}' needs to be emptied before deletion".format(
                         bucket_name), utils.PrintStyle.WARNING)
-                    self.empty_bucket(bucket_name)
+                    if not self.empty_bucket(bucket_name):
+                        return None
                 logging.info("Deleting bucket '{}'".format(bucket_name))
-                self.client.delete_bucket(Bucket=bucket_name)
+                self.rate.call(self.client_for(bucket_name).delete_bucket, Bucket=bucket_name)
             except botocore.exceptions.ClientError as e:
                 utils.print_string("Could not delete bucket '{}' : {}".format(
                     bucket_name, e), utils.PrintStyle.ERROR)
@@ -401,14 +729,46 @@ class S3(DataService):
         """
         if isinstance(self.client, botocore.client.BaseClient):
             logging.info("Cleaning up S3 resources")
-            self.client.close()
+            for client in list(self.clients.values()) + list(self.transfer_clients.values()):
+                client.close()
         else:
             logging.warning("Error when cleaning up S3 resources.")
 
 
+def entry_key(entry):
+    """
+    Sort key of a shard plan entry, matching the order S3 lists keys in,
+    which is also the first key it covers
+    """
+    kind, value = entry
+    return value['Key'] if kind == 'object' else value
+
+
+def classify_error(e):
+    """
+    Decide whether a failed S3 call should be retried
+
+    Returns None for errors that can't be retried, otherwise a
+    (throttled, retry_after) pair
+    """
+    if isinstance(e, botocore.exceptions.ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if code in THROTTLING_CODES or status == 503:
+            return True, None
+        if code == 'InternalError' or status == 500:
+            return False, None
+    if isinstance(e, (botocore.exceptions.EndpointConnectionError,
+                      botocore.exceptions.ConnectionClosedError,
+                      botocore.exceptions.ReadTimeoutError)):
+        return False, None
+    return None
+
+
 def authenticate():
     """
-    Authenticates using AWS IAM Identity Center
+    Authenticates using AWS IAM Identity Center, returning the session that
+    regional clients are created from
 
     Setup as described in: https://docs.aws.amazon.com/cli/latest/userguide/sso-configure-profile-token.html
     needs to first be completed
@@ -419,6 +779,7 @@ def authenticate():
 
         client = session.client('s3')
         client.list_buckets()
+        client.close()
     except botocore.exceptions.TokenRetrievalError as e:
         utils.print_string("Error while authenticating, please run the 'aws sso login' command to refresh access token",utils.PrintStyle.ERROR)
         sys.exit()
@@ -426,4 +787,4 @@ def authenticate():
         utils.print_string("Error whie authenticating: {}".format(e),utils.PrintStyle.ERROR)
         sys.exit()
 
-    return client
+    return session
@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from services.transfer import MAX_WORKERS, cancel_event
+
+
+class Scheduler:
+    """
+    Runs blocking provider operations from asyncio code on a bounded executor
+
+    Every operation counts against a global cap and, optionally, against a
+    cap for its provider. The caps count whole operations, not API calls:
+    each operation still runs its own transfer workers underneath, up to the
+    max_workers of its service, paced by the service's RateController
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, provider_limits=None):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.global_limit = asyncio.Semaphore(max_workers)
+        self.provider_limits = {
+            provider: asyncio.Semaphore(limit)
+            for provider, limit in (provider_limits or {}).items()
+        }
+
+    async def run(self, provider, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) on the executor once both the global and
+        the provider's caps allow it, and return its result
+
+        If the awaiting task is cancelled, the call is asked to stop through
+        transfer.cancel_event: transfers that haven't started are dropped,
+        while the ones in flight finish
+        """
+        # The provider's cap is taken first, so that calls waiting for a busy
+        # provider don't hold global slots other providers could use
+        limit = self.provider_limits.get(provider)
+        if limit is not None:
+            await limit.acquire()
+        try:
+            async with self.global_limit:
+                cancelled = threading.Event()
+                context = contextvars.copy_context()
+                context.run(cancel_event.set, cancelled)
+                call = functools.partial(context.run, func, *args, **kwargs)
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+                except asyncio.CancelledError:
+                    logging.info("Cancelling {} call".format(provider or 'scheduled'))
+                    cancelled.set()
+                    raise
+        finally:
+            if limit is not None:
+                limit.release()
+
+    async def map(self, func, items, provider=None):
+        """
+        Call func on every item of the given iterable or async iterable,
+        yielding an (item, result, exception) tuple for every call as calls
+        complete
+
+        provider is the provider whose cap applies to every call, or a
+        function returning it for a given item. Items are pulled only as
+        calls complete, so that at most twice the global cap are scheduled
+        at once however many items there are. Closing the generator early
+        cancels the calls still scheduled
+        """
+        async def call(item):
+            name = provider(item) if callable(provider) else provider
+            try:
+                return item, await self.run(name, func, item), None
+            except Exception as e:
+                return item, None, e
+
+        if hasattr(items, '__aiter__'):
+            iterator = items.__aiter__()
+            next_item = iterator.__anext__
+        else:
+            iterator = iter(items)
+
+            async def next_item():
+                try:
+                    return next(iterator)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                # Top up the scheduled calls
+                while not exhausted and len(pending) < 2 * self.max_workers:
+                    try:
+                        item = await next_item()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(call(item)))
+
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def close(self):
+        """
+        Wait for calls still running on the executor
+        """
+        self.executor.shutdown(wait=True)
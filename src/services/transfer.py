@@ -0,0 +1,284 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from itertools import islice
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import utils
+
+MB = 1024 * 1024
+
+# Default number of transfers kept in flight at once
+MAX_WORKERS = 16
+
+# Files larger than this are downloaded as concurrent byte ranges
+RANGED_THRESHOLD = 64 * MB
+RANGE_SIZE = 16 * MB
+
+
+# Set when the job running in the current context should stop starting new transfers
+cancel_event = contextvars.ContextVar('cancel_event', default=None)
+
+
+class TransferCancelled(Exception):
+    pass
+
+
+def run_concurrently(func, items, max_workers=MAX_WORKERS):
+    """
+    Call func on every item of the given iterable using a pool of worker threads
+
+    Items are pulled lazily from the iterable, so that at most 2 * max_workers
+    calls are pending at any time, no matter how many items there are.
+
+    Yields an (item, result, exception) tuple for every call, as calls complete.
+    Raises TransferCancelled if the cancel_event of the caller's context is set
+    """
+    max_pending = 2 * max_workers
+    cancelled = cancel_event.get()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        iterator = iter(items)
+        exhausted = False
+        try:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise TransferCancelled("Transfer cancelled")
+
+                # Top up the queue of pending calls
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    # Workers run in the caller's context, e.g. its output sink
+                    context = contextvars.copy_context()
+                    pending[executor.submit(context.run, func, item)] = item
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        yield item, future.result(), None
+                    else:
+                        yield item, None, exception
+        finally:
+            # If the consumer stopped early, drop calls that haven't started
+            for future in pending:
+                future.cancel()
+
+
+def chunked(iterable, size):
+    """
+    Yield successive lists of up to size items from the given iterable
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Prefetcher:
+    """
+    Iterates over an iterable in a background thread, starting as soon as
+    it is created
+
+    Up to depth items are produced ahead of the consumer. Exceptions raised
+    by the producer are re-raised in the consumer
+    """
+    DONE = object()
+
+    def __init__(self, iterable, depth=2):
+        self.iterable = iterable
+        self.queue = Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.producer = threading.Thread(
+            target=contextvars.copy_context().run, args=(self.produce,), daemon=True)
+        self.producer.start()
+
+    def put(self, entry):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce(self):
+        try:
+            for item in self.iterable:
+                if not self.put((item, None)):
+                    return
+            self.put((self.DONE, None))
+        except Exception as e:
+            self.put((self.DONE, e))
+
+    def __iter__(self):
+        while True:
+            item, exception = self.queue.get()
+            if item is self.DONE:
+                if exception is not None:
+                    raise exception
+                return
+            yield item
+
+    def close(self):
+        """
+        Let the producer exit if the consumer stopped early
+        """
+        self.stop.set()
+
+
+def prefetch(iterable, depth=2):
+    """
+    Iterate over the given iterable in a background thread
+
+    Up to depth items are produced ahead of the consumer, so that slow
+    producers (e.g. paginated listings) overlap with processing. Exceptions
+    raised by the producer are re-raised in the consumer
+    """
+    prefetcher = Prefetcher(iterable, depth)
+    try:
+        yield from prefetcher
+    finally:
+        prefetcher.close()
+
+
+def chain_ahead(iterables, window=MAX_WORKERS, depth=2):
+    """
+    Chain the given iterables in order, while the next window of them are
+    already being iterated in background threads
+
+    Each running iterable is at most depth items ahead, so memory use is
+    bounded however long the iterables are
+    """
+    iterables = iter(iterables)
+    running = deque()
+    try:
+        while True:
+            for iterable in islice(iterables, window - len(running)):
+                running.append(Prefetcher(iterable, depth))
+            if not running:
+                return
+            yield from running[0]
+            running.popleft()
+    finally:
+        for prefetcher in running:
+            prefetcher.close()
+
+
+def ranged_download(fetch_range, size, path, range_size=RANGE_SIZE, max_workers=MAX_WORKERS):
+    """
+    Download a remote file of the given size to path using concurrent ranged reads
+
+    fetch_range(start, end) must return the bytes of the remote file in the
+    inclusive range [start, end]. The local file is preallocated, and every
+    range is written at its offset as soon as it arrives
+    """
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    def fetch(start):
+        end = min(start + range_size, size) - 1
+        data = fetch_range(start, end)
+        if len(data) != end - start + 1:
+            raise IOError("Expected {} bytes at offset {}, got {}".format(
+                end - start + 1, start, len(data)))
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        return len(data)
+
+    downloaded = 0
+    for start, length, e in run_concurrently(fetch, range(0, size, range_size), max_workers):
+        if e is not None:
+            raise e
+        downloaded += length
+        logging.info("Downloaded {:.2f} of {:.2f} MB".format(
+            downloaded / MB, size / MB))
+    return downloaded
+
+
+# Counts what the job running in the current context transferred, if set
+job_stats = contextvars.ContextVar('job_stats', default=None)
+
+
+class JobStats:
+    """
+    Thread-safe count of the items and bytes transferred by a job
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.bytes = 0
+
+    def add(self, size):
+        with self.lock:
+            self.items += 1
+            self.bytes += size
+
+
+def record_transfer(size):
+    """
+    Count a transferred item of size bytes against the job running in the
+    current context, if any
+    """
+    stats = job_stats.get()
+    if stats is not None:
+        stats.add(size)
+
+
+class TransferSummary:
+    """
+    Thread-safe aggregate of the outcome of a batch of transfers
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.count = 0
+        self.bytes = 0
+        self.failures = []
+
+    def add_success(self, name, size=0):
+        with self.lock:
+            self.count += 1
+            self.bytes += size
+        record_transfer(size)
+
+    def add_failure(self, name, error):
+        with self.lock:
+            self.failures.append((name, error))
+
+    def report(self, action):
+        """
+        Print aggregate throughput and every failed item
+
+        Returns true if there were no failures, otherwise returns false
+        """
+        elapsed = max(time.time() - self.start, 1e-6)
+        logging.info("{} {} items ({:.2f} MB) in {:.2f} seconds".format(
+            action, self.count, self.bytes / MB, elapsed))
+        utils.print_string("{} {} items, {:.2f} MB at {:.2f} MB/s".format(
+            action, self.count, self.bytes / MB, self.bytes / MB / elapsed))
+
+        for name, error in self.failures:
+            utils.print_string("Failed '{}': {}".format(
+                name, error), utils.PrintStyle.ERROR)
+        if self.failures:
+            utils.print_string("{} items failed".format(
+                len(self.failures)), utils.PrintStyle.ERROR)
+        return not self.failures
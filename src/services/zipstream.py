@@ -0,0 +1,327 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+from queue import Queue, Empty, Full
+from services.transfer import record_transfer
+
+LOCAL_FILE_HEADER = b'PK\x03\x04'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+
+# Signature, CRC-32 and the start of the sizes of a data descriptor
+DESCRIPTOR_SIZE = 16
+
+STORED = 0
+DEFLATED = 8
+
+# Maximum number of bytes inflated from the archive in one step
+OUTPUT_SIZE = 1024 * 1024
+
+
+class ZipStreamError(Exception):
+    pass
+
+
+class ChunkReader:
+    """
+    Reads exact amounts of data from an iterable of byte chunks
+
+    Only the current chunk is buffered, so memory use doesn't depend on the
+    size of the stream
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size):
+        """
+        Return up to size bytes, or b'' at the end of the stream
+        """
+        while self.offset >= len(self.buffer):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b''
+            self.buffer = chunk
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ZipStreamError("Unexpected end of zip stream")
+            data += chunk
+        return data
+
+    def unread(self, data):
+        """
+        Push back data read past the end of an entry
+        """
+        if data:
+            self.buffer = data + self.buffer[self.offset:]
+            self.offset = 0
+
+
+def safe_path(target_dir, name):
+    """
+    Return the local path of an archive entry, refusing names that would
+    escape target_dir
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if name.startswith('/') or '..' in parts:
+        raise ZipStreamError("Unsafe path in zip stream: '{}'".format(name))
+    return os.path.join(target_dir, *parts)
+
+
+def scan_stored_entry(reader, write):
+    """
+    Pass the data of a stored entry whose size is only given in the data
+    descriptor that follows it to write
+
+    The end of the entry is found by looking for a descriptor signature
+    whose CRC-32 and size match the data before it. Only the bytes that
+    could still belong to a descriptor are held back
+
+    Return the CRC-32 of the data
+    """
+    checksum = 0
+    written = 0
+    pending = b''
+    while True:
+        data = reader.read(OUTPUT_SIZE)
+        if not data:
+            raise ZipStreamError("Unexpected end of zip stream")
+        pending += data
+
+        # Bytes before keep can't start a descriptor and are safe to write
+        keep = max(len(pending) - DESCRIPTOR_SIZE + 1, 0)
+        index = pending.find(DATA_DESCRIPTOR)
+        while index != -1:
+            if len(pending) < index + DESCRIPTOR_SIZE:
+                keep = min(keep, index)
+                break
+            crc, size32 = struct.unpack('<II', pending[index + 4:index + 12])
+            size64, = struct.unpack('<Q', pending[index + 8:index + 16])
+            candidate = zlib.crc32(pending[:index], checksum)
+            if crc == candidate and written + index in (size32, size64):
+                write(pending[:index])
+                reader.unread(pending[index:])
+                return candidate
+            index = pending.find(DATA_DESCRIPTOR, index + 1)
+
+        write(pending[:keep])
+        checksum = zlib.crc32(pending[:keep], checksum)
+        written += keep
+        pending = pending[keep:]
+
+
+def copy_entry(reader, method, compressed_size, has_descriptor, write):
+    """
+    Pass the uncompressed data of an entry to write, at most OUTPUT_SIZE
+    bytes at a time
+
+    Return the CRC-32 of the data
+    """
+    checksum = 0
+    if method == STORED and has_descriptor:
+        return scan_stored_entry(reader, write)
+    if method == STORED:
+        remaining = compressed_size
+        while remaining:
+            data = reader.read(min(remaining, OUTPUT_SIZE))
+            if not data:
+                raise ZipStreamError("Unexpected end of zip stream")
+            remaining -= len(data)
+            write(data)
+            checksum = zlib.crc32(data, checksum)
+        return checksum
+
+    if not has_descriptor and compressed_size == 0:
+        return checksum
+
+    # Inflate until the end of the deflate stream, whose size may be unknown
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    remaining = None if has_descriptor else compressed_size
+    while not decompressor.eof:
+        size = OUTPUT_SIZE if remaining is None else min(remaining, OUTPUT_SIZE)
+        data = reader.read(size) if size else b''
+        if not data:
+            raise ZipStreamError("Unexpected end of zip stream")
+        if remaining is not None:
+            remaining -= len(data)
+        while data and not decompressor.eof:
+            output = decompressor.decompress(data, OUTPUT_SIZE)
+            write(output)
+            checksum = zlib.crc32(output, checksum)
+            data = decompressor.unconsumed_tail
+
+    # Give back whatever was read past the end of the entry
+    reader.unread(decompressor.unused_data)
+    return checksum
+
+
+def extract_stream(chunks, target_dir):
+    """
+    Extract a zip archive into target_dir while it is being received
+
+    chunks is an iterable of byte strings, e.g. the body of an HTTP response.
+    Entries are parsed from their local headers as they arrive and written
+    straight to disk, so the archive itself is never stored and memory use
+    stays bounded however large it is
+
+    Every extracted file is counted with transfer.record_transfer
+
+    Returns the number of extracted files
+    """
+    reader = ChunkReader(chunks)
+    count = 0
+    while True:
+        # Central directory reached, all entries have been extracted
+        if reader.read_exact(4) != LOCAL_FILE_HEADER:
+            break
+
+        (version, flags, method, mtime, mdate, crc, compressed_size, size,
+         name_length, extra_length) = struct.unpack('<HHHHHIIIHH', reader.read_exact(26))
+        name = reader.read_exact(name_length)
+        name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read_exact(extra_length)
+
+        if flags & 0x1:
+            raise ZipStreamError("Encrypted entry '{}' is not supported".format(name))
+        if method not in (STORED, DEFLATED):
+            raise ZipStreamError("Compression method {} of '{}' is not supported".format(
+                method, name))
+
+        # Zip64 entries store their real sizes in an extra field
+        zip64 = False
+        while len(extra) >= 4:
+            header_id, length = struct.unpack('<HH', extra[:4])
+            if header_id == 0x0001:
+                zip64 = True
+                values = list(struct.unpack('<%dQ' % (length // 8), extra[4:4 + length // 8 * 8]))
+                if size == 0xFFFFFFFF and values:
+                    size = values.pop(0)
+                if compressed_size == 0xFFFFFFFF and values:
+                    compressed_size = values.pop(0)
+            extra = extra[4 + length:]
+
+        # Sizes and CRC follow the data in a descriptor
+        has_descriptor = flags & 0x8
+        path = safe_path(target_dir, name)
+        if name.endswith('/'):
+            logging.info("Creating local directory '{}'".format(path))
+            os.makedirs(path, exist_ok=True)
+            checksum = copy_entry(reader, method, compressed_size,
+                                  has_descriptor, lambda data: None)
+        else:
+            logging.info("Extracting '{}'".format(path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                checksum = copy_entry(reader, method, compressed_size,
+                                      has_descriptor, f.write)
+                record_transfer(f.tell())
+            count += 1
+
+        if has_descriptor:
+            data = reader.read_exact(4)
+            if data == DATA_DESCRIPTOR:
+                data = reader.read_exact(4)
+            crc, = struct.unpack('<I', data)
+            reader.read_exact(16 if zip64 else 8)
+
+        if checksum != crc:
+            raise ZipStreamError("CRC mismatch for '{}'".format(name))
+    return count
+
+
+class PipeWriter:
+    """
+    Writable file-like object that hands data over to a consumer thread
+    through a bounded queue
+
+    A writer that gets ahead of the consumer blocks, so at most depth
+    chunks are held in memory
+    """
+
+    def __init__(self, depth=16):
+        self.queue = Queue(maxsize=depth)
+        self.aborted = threading.Event()
+        self.error = None
+
+    def write(self, data):
+        while True:
+            if self.aborted.is_set():
+                raise ZipStreamError("Consumer stopped reading the zip stream")
+            try:
+                self.queue.put(bytes(data), timeout=0.1)
+                return len(data)
+            except Full:
+                continue
+
+    def flush(self):
+        pass
+
+    def close(self):
+        while not self.aborted.is_set():
+            try:
+                self.queue.put(None, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            try:
+                chunk = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if chunk is None:
+                return
+            yield chunk
+
+
+def extract_written(produce, target_dir):
+    """
+    Extract a zip archive that produce(stream) writes into a file-like
+    object, for SDK calls that download into a stream rather than
+    returning the response
+
+    produce runs in a background thread while entries are extracted
+
+    Returns the number of extracted files
+    """
+    pipe = PipeWriter()
+
+    def run():
+        try:
+            produce(pipe)
+        except Exception as e:
+            pipe.error = e
+        finally:
+            pipe.close()
+
+    producer = threading.Thread(target=run, daemon=True)
+    producer.start()
+    try:
+        count = extract_stream(pipe, target_dir)
+
+        # Drain whatever follows the entries, i.e. the central directory
+        for chunk in pipe:
+            pass
+    except ZipStreamError:
+        # Stream was cut short because the download itself failed
+        if pipe.error is None:
+            raise
+    finally:
+        pipe.aborted.set()
+        producer.join()
+
+    if pipe.error is not None:
+        raise pipe.error
+    return count
@@ -1,4 +1,5 @@
 import contextlib
+import contextvars
 import logging
 import time
 from enum import Enum
@@ -11,7 +12,18 @@ class PrintStyle(Enum):
     ERROR = 3
     SUCCESS = 4
 
+# Receives the output of the job running in the current context instead of
+# stdout, if set. Must provide write(message, style) and log(message)
+output_sink = contextvars.ContextVar('output_sink', default=None)
+
 def print_string(s, style=PrintStyle.INFO):
+    sink = output_sink.get()
+    if sink is not None:
+        sink.write(s, style)
+    else:
+        print_styled(s, style)
+
+def print_styled(s, style=PrintStyle.INFO):
     if style == PrintStyle.INFO:
         print(s)
     elif style == PrintStyle.WARNING: